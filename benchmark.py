@@ -0,0 +1,229 @@
+"""desktop_pet 的无界面基准测试。
+
+在 SDL dummy 视频驱动下运行 DesktopPetWidget，测量绘制、文字换行、状态切换，
+以及经请求调度器调用本地模拟 OpenAI 兼容服务 (流式/非流式) 的延迟。
+结果以 JSON 输出，便于在不同版本之间比较。
+
+用法: python benchmark.py [--iterations N] [--output result.json]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pygame  # noqa: E402
+import desktop_pet  # noqa: E402
+
+LATIN_TEXT = ("The quick brown fox jumps over the lazy dog while the desktop pet keeps "
+              "watching the cursor move across the screen. ") * 80
+CJK_TEXT = "桌面宠物会一直盯着鼠标，并用简短活泼的语气回答你的问题，遇到图片时会仔细分析。" * 250
+MOCK_REPLY = "这是模拟服务返回的回复。It mixes Chinese and English text. " * 20
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    # 模拟 OpenAI 兼容的 chat/completions 接口
+    protocol_version = "HTTP/1.1"
+    first_byte_delay = 0.02
+    chunk_delay = 0.002
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        time.sleep(self.first_byte_delay)
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(MOCK_REPLY), 8):
+                event = {"choices": [{"delta": {"content": MOCK_REPLY[i:i + 8]}}]}
+                self.write_chunk(f"data: {json.dumps(event)}\n\n".encode())
+                time.sleep(self.chunk_delay)
+            self.write_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            out = json.dumps({"choices": [{"message": {"content": MOCK_REPLY}}]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+    def write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+def start_mock_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+
+
+def summarize(samples):
+    # 毫秒为单位的统计
+    ms = sorted(s * 1000 for s in samples)
+    return {
+        "n": len(ms),
+        "mean_ms": round(statistics.fmean(ms), 4),
+        "p50_ms": round(ms[len(ms) // 2], 4),
+        "p95_ms": round(ms[min(len(ms) - 1, int(len(ms) * 0.95))], 4),
+        "max_ms": round(ms[-1], 4),
+    }
+
+
+def timed(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        t = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t)
+    return samples
+
+
+def fill_history(pet, count):
+    pet.chat_history.clear()
+    pet.layout_cache.clear()
+    for i in range(count):
+        if i % 2 == 0:
+            pet.add_to_history("User", f"第 {i} 个问题：这张截图里有什么需要注意的地方？")
+        else:
+            pet.add_to_history("Bot", CJK_TEXT[:120] + LATIN_TEXT[:200])
+
+
+def bench_draw(pet, iterations):
+    results = {}
+    pet.switch_state(desktop_pet.STATE_CHAT)
+    for count in (50, 500):
+        fill_history(pet, count)
+        cold = timed(lambda: (pet.layout_cache.clear(), pet.draw()), max(1, iterations // 10))
+        warm = timed(pet.draw, iterations)
+        results[f"history_{count}"] = {"cold": summarize(cold), "warm": summarize(warm)}
+    return results
+
+
+def bench_wrap(pet, iterations):
+    results = {}
+    width = pet.current_w - 30
+    for name, text in (("latin", LATIN_TEXT), ("cjk", CJK_TEXT)):
+        samples = timed(lambda: pet.wrap_text_dynamic(text, width), iterations)
+        stats = summarize(samples)
+        stats["chars"] = len(text)
+        stats["chars_per_sec"] = round(len(text) / statistics.fmean(samples))
+        results[name] = stats
+    return results
+
+
+def bench_switch_state(pet, iterations):
+    results = {}
+    cycle = [desktop_pet.STATE_CHAT, desktop_pet.STATE_MINI, desktop_pet.STATE_IDLE]
+    pet.switch_state(desktop_pet.STATE_IDLE)
+    for target in cycle:
+        samples = []
+        for _ in range(iterations):
+            pet.switch_state(desktop_pet.STATE_IDLE if target != desktop_pet.STATE_IDLE else desktop_pet.STATE_CHAT)
+            t = time.perf_counter()
+            pet.switch_state(target)
+            samples.append(time.perf_counter() - t)
+        results[f"to_{target}"] = summarize(samples)
+    return results
+
+
+def bench_api(pet, url, iterations):
+    # 经由请求调度器发送，主线程像 run() 一样轮询事件，计时到第一个字符进入打字机缓冲
+    results = {}
+    for stream in (False, True):
+        pet.config.update({"api_url": url, "stream": stream})
+        pet.api = desktop_pet.BackendPool.from_config(pet.config)
+        first, total = [], []
+        for _ in range(iterations):
+            pet.chat_history.clear()
+            t = time.perf_counter()
+            req = pet.requests.submit(prompt="你好", image=None, history=[])
+            ttfc = None
+            done = False
+            while not done:
+                for req_id, kind, data in pet.requests.poll():
+                    if req_id != req["id"]: continue
+                    if ttfc is None and kind in ("chunk", "reply"):
+                        ttfc = time.perf_counter() - t
+                    done = kind in ("done", "error", "cancelled")
+                time.sleep(0.0005)
+            total.append(time.perf_counter() - t)
+            first.append(ttfc if ttfc is not None else total[-1])
+        results["streaming" if stream else "non_streaming"] = {
+            "time_to_first_char": summarize(first),
+            "total": summarize(total),
+        }
+        pet.api.close()
+    return results
+
+
+def git_version():
+    try:
+        out = subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="desktop_pet 无界面基准测试")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--output", help="把 JSON 结果写入文件 (默认输出到 stdout)")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    server, url = start_mock_server()
+    workdir = tempfile.mkdtemp(prefix="pet_bench_")
+    with open(os.path.join(workdir, "config.json"), "w", encoding="utf-8") as f:
+        json.dump({"api_key": "bench", "api_url": url, "model": "bench-model", "system_prompt": "bench",
+                   "data_dir": os.path.join(workdir, "data"), "chat_log": False, "history_size": 1000}, f)
+    os.chdir(workdir)
+
+    t = time.perf_counter()
+    pet = desktop_pet.DesktopPetWidget()
+    init_time = time.perf_counter() - t
+
+    report = {
+        "version": git_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "platform": platform.platform(),
+        "iterations": args.iterations,
+        "results": {
+            "init_ms": round(init_time * 1000, 3),
+            "draw": bench_draw(pet, args.iterations),
+            "wrap_text_dynamic": bench_wrap(pet, args.iterations),
+            "switch_state": bench_switch_state(pet, args.iterations),
+            "call_api_thread": bench_api(pet, url, max(1, args.iterations // 5)),
+        },
+    }
+    server.shutdown()
+
+    out = json.dumps(report, indent=2, ensure_ascii=False)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,24 @@
 import pygame
 import sys
+import math
 import random
 import os
 import platform
 import threading
 import json
-import urllib.request
+import time
+import queue
+import socket
+import http.client
+import urllib.parse
 import urllib.error
 import base64
-from PIL import ImageGrab, Image
+import hashlib
+import io
+import itertools
+import bisect
+import re
+from collections import OrderedDict, deque
 
 # 尝试引入 SDL2 Window 对象 (需要安装 pygame-ce)
 try:
@@ -37,6 +47,23 @@ STATUS_TEXT_COLOR = (200, 200, 200)
 
 FONT_SIZE = 16
 STATUS_FONT_SIZE = 12
+LINE_HEIGHT = FONT_SIZE + 6
+LAYOUT_CACHE_SIZE = 200  # 聊天排版缓存最多保留的消息条数
+IMAGE_TOKEN_COST = 1000  # 估算上下文时一张图片按多少 token 计
+HISTORY_SIZE = 200  # 内存中保留的最近消息条数
+HISTORY_LOAD = 30  # 启动时从聊天记录尾部读入的条数
+SCROLLBACK_PAGE = 30  # 向上翻页时每次从文件读入的条数
+SCROLLBACK_LIMIT = 1000  # 翻页缓冲最多保留的条数
+SCROLL_STEP = 3  # 滚轮每格滚动的行数
+TYPE_CPS = 40  # 打字机每秒输出的字符数
+TYPE_BURST_THRESHOLD = 200  # 积压超过这么多字符时开始加速
+TYPE_CATCHUP_SECONDS = 2.0  # 加速时按“剩余积压在这么多秒内打完”计算速度
+
+# 字体候选路径，按顺序探测，找到的路径会缓存到 data_dir 下
+FONT_CANDIDATES = {
+    "Darwin": ["/System/Library/Fonts/PingFang.ttc", "/System/Library/Fonts/STHeiti Light.ttc"],
+    "Windows": ["C:\\Windows\\Fonts\\msyh.ttc", "C:\\Windows\\Fonts\\simhei.ttf"],
+}
 
 # 状态常量
 STATE_IDLE = "idle"
@@ -48,13 +75,1364 @@ EMOTION_HAPPY = "happy"
 EMOTION_ANGRY = "angry"
 EMOTION_THINKING = "thinking"
 
+EMOTION_EYE_COLORS = {
+    EMOTION_NORMAL: EYE_COLOR,
+    EMOTION_HAPPY: (50, 255, 100),
+    EMOTION_ANGRY: (255, 50, 50),
+    EMOTION_THINKING: (255, 200, 0),
+}
+
+# 回复中出现关键词时切换的情绪、血量变化和状态图标；多条规则同时命中时排在前面的优先
+DEFAULT_EMOTION_RULES = [
+    {"keywords": ["哈哈", "开心", "成功"], "emotion": EMOTION_HAPPY, "hp": 1, "icon": ""},
+    {"keywords": ["错误", "error", "失败"], "emotion": EMOTION_ANGRY, "hp": -2, "icon": "!"},
+    {"keywords": ["思考", "thinking"], "emotion": EMOTION_THINKING, "hp": 0, "icon": "?"},
+]
+
+
+def ticks_ms():
+    # 单调毫秒时钟；启动时不再调用 pygame.init()，pygame.time.get_ticks() 会一直返回 0
+    return int(time.monotonic() * 1000)
+
+
+class StartupTimer:
+    # 记录启动各阶段耗时，首帧显示后汇报
+    def __init__(self):
+        self.start = self.last = time.perf_counter()
+        self.phases = []
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        return {"type": "startup", "time": time.time(),
+                "total_ms": round((self.last - self.start) * 1000, 2),
+                "phases": {name: round(sec * 1000, 2) for name, sec in self.phases}}
+
+
+def iter_sse_content(lines):
+    # 解析 OpenAI 兼容接口的 SSE 流，逐块产出增量文本
+    for raw in lines:
+        line = raw.decode("utf-8", "replace").strip() if isinstance(raw, bytes) else raw.strip()
+        if not line.startswith("data:"): continue
+        data = line[5:].strip()
+        if data == "[DONE]": break
+        try:
+            delta = json.loads(data)["choices"][0].get("delta") or {}
+        except (ValueError, KeyError, IndexError):
+            continue
+        if delta.get("content"): yield delta["content"]
+
+
+class ApiError(Exception):
+    pass
+
+
+def abort_conn(conn):
+    # 供其他线程调用：关闭底层 socket，让阻塞中的请求或读取立刻返回
+    sock = conn.sock if conn else None
+    if sock:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class ApiResponse:
+    # 包装一次响应，读完后把连接还给连接池；中途放弃则直接关闭连接
+    def __init__(self, client, conn, resp):
+        self.client = client
+        self.conn = conn
+        self.resp = resp
+        self.status = resp.status
+        self.released = False
+        self.backend = None
+        self.request_bytes = 0
+        self.bytes_read = 0
+
+    def getheader(self, name, default=None):
+        return self.resp.getheader(name, default)
+
+    def read(self):
+        try:
+            data = self.resp.read()
+        except Exception:
+            # 对端重置或被其他线程中止：连接不能再用，但名额要还给连接池
+            self.close()
+            raise
+        self.bytes_read += len(data)
+        self.release()
+        return data
+
+    def __iter__(self):
+        while True:
+            line = self.resp.readline()
+            if not line: break
+            self.bytes_read += len(line)
+            yield line
+
+    def release(self, reuse=True):
+        if self.released: return
+        self.released = True
+        reusable = reuse and self.resp.isclosed() and not self.resp.will_close
+        self.client.release_conn(self.conn, reusable)
+
+    def close(self):
+        self.release(reuse=False)
+
+    def abort(self):
+        abort_conn(self.conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None and not self.released:
+            # 正常结束时把剩余内容 (如 SSE 的结束块) 读完，连接才能复用
+            try:
+                self.resp.read()
+            except (OSError, http.client.HTTPException):
+                pass
+        self.release(reuse=exc_type is None)
+
+
+class ApiClient:
+    # 长期持有的 HTTP/1.1 客户端：keep-alive 连接池 + 429/5xx 指数退避重试
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, url, api_key="", connect_timeout=5.0, read_timeout=60.0,
+                 max_retries=3, backoff=0.5, pool_size=2):
+        parts = urllib.parse.urlsplit(url or "")
+        self.scheme = parts.scheme or "http"
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        self.api_key = api_key
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(pool_size)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get("api_url"), config.get("api_key", ""),
+                   connect_timeout=config.get("connect_timeout", 5.0),
+                   read_timeout=config.get("read_timeout", 60.0),
+                   max_retries=config.get("max_retries", 3),
+                   pool_size=config.get("pool_size", 2))
+
+    def new_conn(self):
+        if not self.host: raise ApiError("api_url 未配置")
+        conn_cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+        return conn_cls(self.host, self.port, timeout=self.connect_timeout)
+
+    def acquire_conn(self):
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self.new_conn()
+        except Exception:
+            # 建不了连接 (如 api_url 未配置) 时把名额还回去，否则后续请求会一直阻塞
+            self.slots.release()
+            raise
+
+    def release_conn(self, conn, reusable):
+        if reusable:
+            self.idle.put(conn)
+        else:
+            conn.close()
+        self.slots.release()
+
+    def post(self, payload, track=None):
+        # track 不为 None 时把正在使用的连接记在 track["conn"]，其他线程可以借此中止请求
+        body = json.dumps(payload).encode()
+        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {self.api_key}"}
+        attempt = 0
+        while True:
+            conn = self.acquire_conn()
+            if track is not None: track["conn"] = conn
+            reused = conn.sock is not None
+            sent = False
+            try:
+                if not reused:
+                    conn.connect()
+                    conn.sock.settimeout(self.read_timeout)
+                conn.request("POST", self.path, body, headers)
+                sent = True
+                resp = conn.getresponse()
+            except (OSError, http.client.HTTPException) as e:
+                self.release_conn(conn, False)
+                # 被其他线程中止的请求不再重试
+                if track is not None and track.get("aborted"): raise
+                # 空闲连接早已被服务端关掉 (对方断开/重置)，服务端没有收到请求，换新连接立即重试
+                if reused and isinstance(e, (ConnectionResetError, BrokenPipeError)): continue
+                # 请求发出后读超时：服务端可能还在处理，重发会重复计费，慢后端交给对冲请求处理
+                if sent and isinstance(e, TimeoutError): raise
+                if attempt >= self.max_retries: raise
+                time.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+                continue
+
+            res = ApiResponse(self, conn, resp)
+            if resp.status in self.RETRY_STATUS and attempt < self.max_retries:
+                res.read()
+                delay = self.backoff * 2 ** attempt
+                try:
+                    delay = max(delay, float(resp.getheader("Retry-After", 0)))
+                except ValueError:
+                    pass
+                time.sleep(delay)
+                attempt += 1
+                continue
+            if resp.status >= 400:
+                raise ApiError(f"HTTP {resp.status}: {res.read()[:200].decode('utf-8', 'replace')}")
+            res.request_bytes = len(body)
+            return res
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class Backend:
+    # 一个 OpenAI 兼容后端：自己的连接池、模型名、权重和熔断状态
+    def __init__(self, client, model=None, weight=1.0, name=None):
+        self.client = client
+        self.model = model
+        self.weight = weight
+        self.name = name or client.host
+        self.failures = 0
+        self.opened_at = None
+
+    def available(self, now, cooldown):
+        # 熔断打开后冷却期内不参与选择，冷却期过后放行请求试探 (半开)
+        return self.opened_at is None or now - self.opened_at >= cooldown
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self, now, threshold):
+        self.failures += 1
+        if self.failures >= threshold or self.opened_at is not None:
+            self.opened_at = now
+
+
+class BackendPool:
+    # 按权重选择后端；首字节迟迟不到就向另一个后端发一份对冲请求，先到者胜出，另一份中止
+    # 失败时换下一个后端，连续失败的后端被熔断一段时间
+    def __init__(self, backends, hedge_ms=2000, breaker_failures=3, breaker_cooldown=30.0):
+        self.backends = backends
+        self.hedge_delay = hedge_ms / 1000 if hedge_ms else None
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        # 没有 backends 列表时退回到单个 api_url/api_key/model
+        entries = config.get("backends") or [{"api_url": config.get("api_url"), "api_key": config.get("api_key", "")}]
+        backends = []
+        for entry in entries:
+            client = ApiClient.from_config({**config, **entry})
+            backends.append(Backend(client, entry.get("model") or config.get("model"),
+                                    weight=entry.get("weight", 1.0), name=entry.get("name")))
+        return cls(backends, hedge_ms=config.get("hedge_ms", 2000),
+                   breaker_failures=config.get("breaker_failures", 3),
+                   breaker_cooldown=config.get("breaker_cooldown", 30.0))
+
+    def choose(self, exclude):
+        now = time.monotonic()
+        with self.lock:
+            rest = [b for b in self.backends if b not in exclude and b.weight > 0]
+            healthy = [b for b in rest if b.available(now, self.breaker_cooldown)]
+        # 全部熔断时仍然试一试，总比直接报错好
+        candidates = healthy or rest
+        if not candidates: return None
+        return random.choices(candidates, weights=[b.weight for b in candidates])[0]
+
+    def post(self, payload, cancel=None):
+        # 返回胜出后端的 ApiResponse，res.backend 指向该后端
+        results = queue.Queue()
+        tracks = {}
+        tried = set()  # 本次请求已经用过的后端，失败转移和对冲都不再选它们
+
+        def attempt(backend, track):
+            body = dict(payload, model=backend.model) if backend.model else payload
+            try:
+                results.put((backend, backend.client.post(body, track), None))
+            except Exception as e:
+                results.put((backend, None, e))
+
+        def launch():
+            backend = self.choose(tried)
+            if backend is None: return False
+            tried.add(backend)
+            tracks[backend] = {}
+            threading.Thread(target=attempt, args=(backend, tracks[backend]), daemon=True).start()
+            return True
+
+        if not launch(): raise ApiError("没有可用的后端")
+        pending = 1
+        hedge_at = time.monotonic() + self.hedge_delay if self.hedge_delay else None
+        error = None
+        while pending:
+            if cancel is not None and cancel.is_set():
+                self.discard(tracks, results, pending)
+                raise RequestCancelled()
+            timeout = 0.05
+            if hedge_at is not None:
+                timeout = min(timeout, max(0.0, hedge_at - time.monotonic()))
+            try:
+                backend, res, exc = results.get(timeout=timeout)
+            except queue.Empty:
+                if hedge_at is not None and time.monotonic() >= hedge_at:
+                    hedge_at = None
+                    pending += launch()
+                continue
+            pending -= 1
+            del tracks[backend]
+            with self.lock:
+                if exc is None:
+                    backend.record_success()
+                else:
+                    backend.record_failure(time.monotonic(), self.breaker_failures)
+            if exc is None:
+                self.discard(tracks, results, pending)
+                res.backend = backend
+                return res
+            error = exc
+            # 失败立即换下一个后端，不再等对冲计时
+            if not pending:
+                hedge_at = None
+                pending += launch()
+        raise error
+
+    def discard(self, tracks, results, pending):
+        # 中止落败的请求；它们的结果在后台收走并关闭连接
+        for track in tracks.values():
+            track["aborted"] = True
+            abort_conn(track.get("conn"))
+        if not pending: return
+
+        def reap():
+            for _ in range(pending):
+                res = results.get()[1]
+                if res: res.close()
+        threading.Thread(target=reap, daemon=True).start()
+
+    def status(self):
+        now = time.monotonic()
+        return [{"name": b.name, "model": b.model, "weight": b.weight, "failures": b.failures,
+                 "open": not b.available(now, self.breaker_cooldown)} for b in self.backends]
+
+    def close(self):
+        for backend in self.backends:
+            backend.client.close()
+
+
+class TokenBucket:
+    # 令牌桶限流：每秒补充 rate 个令牌，最多攒 capacity 个
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1: return False
+        self.tokens -= 1
+        return True
+
+
+def dhash(img, size=8):
+    # 差值哈希：缩成 (size+1)×size 的灰度图，比较左右相邻像素，得到 size*size 位整数
+    from PIL import Image
+    small = img.convert("L").resize((size + 1, size), Image.BILINEAR, reducing_gap=2.0)
+    px = small.tobytes()
+    bits = 0
+    for row in range(size):
+        base = row * (size + 1)
+        for col in range(size):
+            bits = (bits << 1) | (px[base + col] > px[base + col + 1])
+    return bits
+
+
+class ScreenWatcher:
+    # 观察模式：后台线程定时截屏并计算感知哈希，画面变化超过阈值且令牌桶有余量时，
+    # 把编码好的图片放进 frames 交给主循环发送；截屏、哈希和编码都不占用渲染线程
+    def __init__(self, pipeline, interval=5.0, region=None, threshold=10, rate_per_min=2, burst=1, ready=None):
+        self.pipeline = pipeline
+        self.interval = interval
+        self.bbox = (region[0], region[1], region[0] + region[2], region[1] + region[3]) if region else None
+        self.threshold = threshold
+        self.bucket = TokenBucket(rate_per_min / 60, burst)
+        self.ready = ready or (lambda: True)
+        self.enabled = False
+        self.last_hash = None
+        self.frames = queue.Queue()
+        self.wake = threading.Event()
+        self.thread = None
+
+    @classmethod
+    def from_config(cls, config, pipeline, ready=None):
+        return cls(pipeline, interval=config.get("watch_interval", 5.0), region=config.get("watch_region"),
+                   threshold=config.get("watch_threshold", 10), rate_per_min=config.get("watch_rate", 2),
+                   burst=config.get("watch_burst", 1), ready=ready)
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self.last_hash = None
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.worker, daemon=True)
+            self.thread.start()
+        self.wake.set()
+        return self.enabled
+
+    def worker(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            # 请求还在进行或回复还在打字时先不截屏，免得评论堆积
+            if not self.enabled or not self.ready(): continue
+            try:
+                self.capture()
+            except Exception as e:
+                self.enabled = False
+                self.frames.put(e)
+
+    def capture(self):
+        from PIL import ImageGrab
+        img = ImageGrab.grab(bbox=self.bbox)
+        h = dhash(img)
+        # 和上一次发送的画面比较；被限流的变化保留到令牌补上后再发
+        if self.last_hash is not None and bin(h ^ self.last_hash).count("1") <= self.threshold: return
+        if not self.bucket.take(): return
+        self.last_hash = h
+        self.frames.put(self.pipeline.process(img, preview=False))
+
+
+class ImagePipeline:
+    # 后台线程完成解码、缩放和重新编码，全程在内存中进行，不写临时文件
+    def __init__(self, max_edge=1568, max_pixels=1568 * 1568, fmt="JPEG", quality=85):
+        self.max_edge = max_edge
+        self.max_pixels = max_pixels
+        self.fmt = fmt.upper()
+        self.quality = quality
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        threading.Thread(target=self.worker, daemon=True).start()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(max_edge=config.get("image_max_edge", 1568),
+                   max_pixels=config.get("image_max_pixels", 1568 * 1568),
+                   fmt=config.get("image_format", "JPEG"),
+                   quality=config.get("image_quality", 85))
+
+    def submit(self, source):
+        # source 可以是 PIL Image，也可以是图片文件路径
+        self.jobs.put(source)
+
+    def worker(self):
+        while True:
+            source = self.jobs.get()
+            try:
+                self.results.put(self.process(source))
+            except Exception as e:
+                self.results.put(e)
+
+    def open_image(self, source):
+        from PIL import Image
+        if isinstance(source, Image.Image): return source
+        img = Image.open(source)
+        # JPEG 可以在解码阶段直接按 1/2、1/4、1/8 缩小，大文件不必完整解码
+        img.draft("RGB", (self.max_edge, self.max_edge))
+        return img
+
+    def process(self, source, preview=True):
+        from PIL import Image
+        img = self.open_image(source)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+
+        w, h = img.size
+        scale = min(1.0, self.max_edge / max(w, h), (self.max_pixels / (w * h)) ** 0.5)
+        if scale < 1.0:
+            img = img.resize((max(1, int(w * scale)), max(1, int(h * scale))), Image.LANCZOS, reducing_gap=3.0)
+
+        buf = io.BytesIO()
+        img.save(buf, self.fmt, quality=self.quality)
+
+        image = {"data": buf.getvalue(), "mime": f"image/{self.fmt.lower()}", "surf": None}
+        if preview:
+            # 输入框里的 50px 预览图
+            w, h = img.size
+            thumb = img.convert("RGB").resize((max(1, int(w * 50 / h)), 50), Image.BILINEAR)
+            image["surf"] = pygame.image.frombytes(thumb.tobytes(), thumb.size, "RGB")
+        return image
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+class RequestScheduler:
+    # 所有 API 请求都交给这一个工作线程按提交顺序处理，同一时间只有一个请求在进行
+    # 排队上限满了 submit 返回 None；结果以 (请求 id, 类型, 数据) 事件放进 events，
+    # 由主循环取出处理，界面状态只在主线程修改
+    def __init__(self, handler, max_pending=3):
+        self.handler = handler
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.events = queue.Queue()
+        self.ids = itertools.count(1)
+        self.current = None
+        self.queued = {}  # 还在排队的请求 id -> 请求
+        self.lock = threading.Lock()
+        threading.Thread(target=self.worker, daemon=True).start()
+
+    @classmethod
+    def from_config(cls, config, handler):
+        return cls(handler, max_pending=config.get("request_queue_size", 3))
+
+    @property
+    def busy(self):
+        return self.current is not None or not self.jobs.empty()
+
+    def full(self):
+        return self.jobs.full()
+
+    def submit(self, **fields):
+        req = {"id": next(self.ids), "cancel": threading.Event(), "response": None, **fields}
+        with self.lock:
+            try:
+                self.jobs.put_nowait(req)
+            except queue.Full:
+                return None
+            self.queued[req["id"]] = req
+        return req
+
+    def cancel(self, req_id=None):
+        # 不指定 id 时取消正在进行的请求；指定了还在排队的请求则在轮到它时直接跳过
+        # 返回被取消的请求 id，id 已经结束或不存在时返回 None
+        with self.lock:
+            req = self.current
+            if req_id is not None and (req is None or req["id"] != req_id):
+                req = self.queued.get(req_id)
+                if req is not None: req["cancel"].set()
+                return req and req["id"]
+            if req is None: return None
+            req["cancel"].set()
+        res = req["response"]
+        if res: res.abort()
+        return req["id"]
+
+    def emit(self, req, kind, data=None):
+        self.events.put((req["id"], kind, data))
+
+    def poll(self):
+        while True:
+            try:
+                yield self.events.get_nowait()
+            except queue.Empty:
+                return
+
+    def worker(self):
+        while True:
+            req = self.jobs.get()
+            with self.lock:
+                del self.queued[req["id"]]
+                if not req["cancel"].is_set(): self.current = req
+            if self.current is not req:
+                self.emit(req, "cancelled")
+                continue
+            try:
+                self.handler(req)
+            except Exception as e:
+                self.emit(req, "error", str(e))
+            finally:
+                self.current = None
+
+
+class ControlClient:
+    # 一个控制连接：读线程把命令交给服务端，写线程把 outbox 里的回复按行发回
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.outbox = queue.Queue()
+        self.closed = False
+        self.eof = False
+        self.pending = 0  # 已交给主循环还没答复的命令数 + 还在等回复的请求数
+        self.lock = threading.Lock()
+        threading.Thread(target=self.reader, daemon=True).start()
+        threading.Thread(target=self.writer, daemon=True).start()
+
+    def send(self, obj):
+        if not self.closed: self.outbox.put(obj)
+
+    def begin(self):
+        with self.lock:
+            self.pending += 1
+
+    def finish(self):
+        # 对方已半关闭 (只关了写端) 时，等所有命令都答复完才结束写线程
+        with self.lock:
+            self.pending -= 1
+            done = self.eof and not self.pending
+        if done: self.outbox.put(None)
+
+    def reader(self):
+        try:
+            with self.sock.makefile("r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip(): continue
+                    try:
+                        cmd = json.loads(line)
+                        if not isinstance(cmd, dict): raise ValueError("命令必须是 JSON 对象")
+                    except ValueError as e:
+                        self.send({"ok": False, "error": f"无效命令: {e}"})
+                        continue
+                    self.server.dispatch(self, cmd)
+        except (OSError, UnicodeDecodeError):
+            pass
+        with self.lock:
+            self.eof = True
+            done = not self.pending
+        if done: self.outbox.put(None)
+
+    def writer(self):
+        while True:
+            obj = self.outbox.get()
+            if obj is None: break
+            try:
+                self.sock.sendall((json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8"))
+            except OSError:
+                break
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class ControlServer:
+    # 本机 TCP 控制端口：每行一条 JSON 命令。命令放进 commands 由主循环执行，
+    # 和键盘输入走同一条请求流程；附带图片路径时在连接线程里先编码好，不占用渲染线程
+    def __init__(self, port, pipeline, token=None, host="127.0.0.1", info_path=None):
+        self.pipeline = pipeline
+        self.token = token
+        self.commands = queue.Queue()
+        self.sock = socket.create_server((host, port))
+        self.port = self.sock.getsockname()[1]
+        # control_port 为 0 时端口由系统分配，写到 info_path 供脚本查找
+        self.info_path = info_path
+        if info_path:
+            try:
+                os.makedirs(os.path.dirname(info_path) or ".", exist_ok=True)
+                with open(info_path, "w", encoding="utf-8") as f:
+                    json.dump({"host": host, "port": self.port, "pid": os.getpid()}, f)
+            except OSError:
+                self.info_path = None
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    @classmethod
+    def from_config(cls, config, pipeline):
+        # 未配置 control_port 时不开端口
+        port = config.get("control_port")
+        if port is None: return None
+        return cls(port, pipeline, token=config.get("control_token"),
+                   info_path=os.path.join(config.get("data_dir", "data"), "control.json"))
+
+    def accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except OSError:
+                return
+            ControlClient(self, sock)
+
+    @staticmethod
+    def validate(cmd):
+        # 字段类型在连接线程里检查，主循环只会拿到格式正确的命令
+        if not isinstance(cmd.get("cmd"), str): return "cmd 必须是字符串"
+        for field in ("text", "image", "state"):
+            if field in cmd and not isinstance(cmd[field], str): return f"{field} 必须是字符串"
+        req_id = cmd.get("id")
+        if req_id is not None and (not isinstance(req_id, int) or isinstance(req_id, bool)): return "id 必须是整数"
+        return None
+
+    def dispatch(self, client, cmd):
+        if self.token and cmd.get("token") != self.token:
+            client.send({"ok": False, "error": "token 不正确"})
+            return
+        error = self.validate(cmd)
+        if error:
+            client.send({"ok": False, "error": error})
+            return
+        if cmd.get("image"):
+            try:
+                cmd["image_data"] = self.pipeline.process(cmd["image"])
+            except Exception as e:
+                client.send({"ok": False, "error": f"图片处理失败: {e}"})
+                return
+        client.begin()
+        self.commands.put((client, cmd))
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        if self.info_path:
+            try:
+                os.remove(self.info_path)
+            except OSError:
+                pass
+
+
+class ResponseCache:
+    # 以 (model, 完整请求上下文) 的哈希为键缓存回复
+    # 内存 LRU 一层 + 磁盘一层，磁盘按过期时间和总大小淘汰
+    def __init__(self, cache_dir, ttl=86400, max_bytes=50 * 1024 * 1024, mem_entries=64):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.mem_entries = mem_entries
+        self.mem = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(os.path.join(config.get("data_dir", "data"), "cache"),
+                   ttl=config.get("cache_ttl", 86400),
+                   max_bytes=int(config.get("cache_max_mb", 50) * 1024 * 1024),
+                   mem_entries=config.get("cache_mem_entries", 64))
+
+    @staticmethod
+    def make_key(model, messages):
+        # messages 是实际发送的完整上下文 (系统提示、历史轮次、本次问题和图片)，
+        # 同一句“继续”在不同对话里不会互相命中
+        h = hashlib.sha256()
+        h.update((model or "").encode("utf-8"))
+        h.update(b"\0")
+        h.update(json.dumps(messages, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+        return h.hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            hit = self.mem.get(key)
+            if hit and now - hit[0] < self.ttl:
+                self.mem.move_to_end(key)
+                self.hits += 1
+                return hit[1]
+        try:
+            path = self.path_for(key)
+            if now - os.path.getmtime(path) >= self.ttl:
+                os.remove(path)
+                raise OSError("expired")
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.remember(key, entry["time"], entry["reply"])
+            self.hits += 1
+        return entry["reply"]
+
+    def remember(self, key, stamp, reply):
+        self.mem[key] = (stamp, reply)
+        self.mem.move_to_end(key)
+        while len(self.mem) > self.mem_entries:
+            self.mem.popitem(last=False)
+
+    def put(self, key, reply):
+        now = time.time()
+        with self.lock:
+            self.remember(key, now, reply)
+        path = self.path_for(key)
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"time": now, "reply": reply}, f, ensure_ascii=False)
+            os.replace(path + ".tmp", path)
+            self.evict()
+        except OSError:
+            pass
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if now - st.st_mtime >= self.ttl:
+                os.remove(path)
+            else:
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes: break
+            os.remove(path)
+            total -= size
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "mem_entries": len(self.mem)}
+
+
+class FrameScheduler:
+    # 记录每个区域上次绘制时的内容签名，签名变化才算脏区；没有动画和输入时降到低帧率
+    # 签名按状态分开记录，因为每个状态有自己的后备画布
+    def __init__(self, active_fps=60, idle_fps=10, linger_ms=500):
+        self.active_fps = active_fps
+        self.idle_fps = idle_fps
+        self.linger_ms = linger_ms
+        self.signatures = {}
+        self.active_until = 0
+        self.present_all = True  # 下一帧需要把整块画布提交到屏幕
+
+    def invalidate(self, scope=None):
+        if scope is None:
+            self.signatures.clear()
+        else:
+            for key in [k for k in self.signatures if k[0] == scope]:
+                del self.signatures[key]
+        self.present_all = True
+
+    def collect(self, regions, scope=None):
+        dirty = []
+        for region in regions:
+            key, sig = (scope, region[0]), region[2]
+            if key not in self.signatures or self.signatures[key] != sig:
+                self.signatures[key] = sig
+                dirty.append(region)
+        return dirty
+
+    def poke(self, now):
+        self.active_until = now + self.linger_ms
+
+    def fps(self, now, animating):
+        return self.active_fps if animating or now < self.active_until else self.idle_fps
+
+
+def estimate_tokens(text):
+    # 粗略估算：中日韩字符约 1 token/字，其余约 4 字符/token
+    # 用 UTF-8 字节数差值统计非 ASCII 字符，避免逐字循环
+    n = len(text)
+    wide = (len(text.encode("utf-8")) - n) // 2
+    return wide + (n - wide) // 4 + 1
+
+
+def image_content(text, image):
+    b64 = base64.b64encode(image["data"]).decode()
+    return [{"type": "text", "text": text},
+            {"type": "image_url", "image_url": {"url": f"data:{image['mime']};base64,{b64}"}}]
+
+
+def build_messages(config, context_builder, prompt, image, history=()):
+    # 界面和批处理共用：系统提示 + 按预算挑选的历史 + 本次的文字/图片
+    if image:
+        current = {"role": "user", "content": image_content(prompt or "图里有什么", image)}
+    else:
+        current = {"role": "user", "content": prompt}
+    return context_builder.build(history, config.get("system_prompt", ""), current)
+
+
+def read_config(path="config.json"):
+    try:
+        with open(path, "r", encoding='utf-8') as f:
+            return json.load(f)
+    except:
+        return {"api_key": "", "api_url": "", "model": "qwen-vl-plus"}
+
+
+class ContextBuilder:
+    # 从 chat_history 由新到旧挑选历史轮次，直到用完 token 预算
+    # 每条消息序列化后的结果和 token 估算按消息 id 缓存，发送时不用重建整段历史
+    def __init__(self, max_tokens=2000, keep_images=1, max_entries=LAYOUT_CACHE_SIZE):
+        self.max_tokens = max_tokens
+        self.keep_images = keep_images
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(max_tokens=config.get("context_max_tokens", 2000),
+                   keep_images=config.get("context_keep_images", 1))
+
+    def message_for(self, msg, with_image):
+        key = (msg["id"], with_image)
+        # 打字机还没打完的 Bot 消息用完整回复
+        source = msg.get("reply", msg["text"])
+        hit = self.entries.get(key)
+        if hit and hit[0] == source:
+            self.entries.move_to_end(key)
+            return hit[1], hit[2]
+
+        if msg["role"] == "User":
+            text = msg.get("prompt", msg["text"])
+            image = msg.get("image")
+            if image and with_image:
+                entry = {"role": "user", "content": image_content(text or "图里有什么", image)}
+                tokens = estimate_tokens(text) + IMAGE_TOKEN_COST
+            else:
+                # 较早的图片只保留文字占位，避免请求体越来越大
+                content = f"{text} [图片]" if image else text
+                entry = {"role": "user", "content": content}
+                tokens = estimate_tokens(content)
+        else:
+            entry = {"role": "assistant", "content": source}
+            tokens = estimate_tokens(source)
+
+        self.entries[key] = (source, entry, tokens)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry, tokens
+
+    def build(self, history, system_prompt, current):
+        msgs = []
+        budget = self.max_tokens - estimate_tokens(system_prompt)
+        content = current["content"]
+        if isinstance(content, list):
+            budget -= estimate_tokens(content[0]["text"]) + IMAGE_TOKEN_COST
+        else:
+            budget -= estimate_tokens(content)
+        images = 0
+        with self.lock:
+            for msg in reversed(history):
+                if msg["role"] not in ("User", "Bot") or not msg.get("reply", msg["text"]): continue
+                has_image = bool(msg.get("image"))
+                entry, tokens = self.message_for(msg, has_image and images < self.keep_images)
+                images += has_image
+                if tokens > budget: break
+                budget -= tokens
+                msgs.append(entry)
+        msgs.reverse()
+        # 上下文必须从用户发言开始
+        while msgs and msgs[0]["role"] != "user":
+            msgs.pop(0)
+        return [{"role": "system", "content": system_prompt}] + msgs + [current]
+
+
+class ChatLog:
+    # 只追加写入的 JSONL 聊天记录。启动时只读文件尾部，翻看更早的记录时再按需往前读，
+    # 所以启动耗时和内存与记录总量无关
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "ab")
+
+    def append(self, msg):
+        # 返回这条记录在文件中的起始偏移，写入失败返回 None
+        line = json.dumps({"time": int(time.time()), "role": msg["role"], "text": msg.get("reply", msg["text"])},
+                          ensure_ascii=False) + "\n"
+        try:
+            pos = self.file.tell()
+            self.file.write(line.encode("utf-8"))
+            self.file.flush()
+            return pos
+        except OSError:
+            return None
+
+    def read_before(self, end, count):
+        # 读取偏移 end 之前的最多 count 条记录，返回 ([(偏移, 记录)...], 第一条的偏移)
+        with open(self.path, "rb") as f:
+            if end is None:
+                f.seek(0, os.SEEK_END)
+                end = f.tell()
+            pos, buf = end, b""
+            while pos > 0 and buf.count(b"\n") <= count:
+                step = min(65536, pos)
+                pos -= step
+                f.seek(pos)
+                buf = f.read(step) + buf
+        lines = buf[:-1].split(b"\n") if buf else []
+        if pos > 0: lines.pop(0)  # 第一段可能是半行
+        lines = lines[-count:] if count else []
+        start = end - sum(len(l) + 1 for l in lines)
+        out, offset = [], start
+        for l in lines:
+            try:
+                out.append((offset, json.loads(l)))
+            except ValueError:
+                pass
+            offset += len(l) + 1
+        return out, start
+
+    def close(self):
+        self.file.close()
+
+
+class EmotionRules:
+    # 所有规则的关键词编译进一个 Aho-Corasick 自动机，一遍扫描即可找出命中的规则，
+    # 耗时只与文本长度有关，和关键词数量无关
+    def __init__(self, rules):
+        self.rules = [r for r in rules if r.get("emotion") in EMOTION_EYE_COLORS]
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [len(self.rules)]  # 该状态能命中的最靠前的规则序号，len(rules) 表示没有
+        for index, rule in enumerate(self.rules):
+            for keyword in rule.get("keywords", ()):
+                node = 0
+                for ch in keyword.lower():
+                    nxt = self.goto[node].get(ch)
+                    if nxt is None:
+                        nxt = len(self.goto)
+                        self.goto[node][ch] = nxt
+                        self.goto.append({})
+                        self.fail.append(0)
+                        self.out.append(len(self.rules))
+                    node = nxt
+                if node: self.out[node] = min(self.out[node], index)
+
+        # 按层 (BFS) 计算失败指针，同时把后缀上的命中合并进来
+        pending = deque(self.goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for ch, nxt in self.goto[node].items():
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = min(self.out[nxt], self.out[self.fail[nxt]])
+                pending.append(nxt)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get("emotion_rules") or DEFAULT_EMOTION_RULES)
+
+    def scanner(self):
+        return EmotionScanner(self)
+
+
+class EmotionScanner:
+    # 对一条回复的增量匹配状态，流式分块依次喂入，跨块的关键词也能命中
+    def __init__(self, rules):
+        self.rules = rules
+        self.node = 0
+        self.best = len(rules.rules)
+
+    @property
+    def rule(self):
+        return self.rules.rules[self.best] if self.best < len(self.rules.rules) else None
+
+    def feed(self, text):
+        # 返回命中的最优规则是否发生了变化
+        goto, fail, out = self.rules.goto, self.rules.fail, self.rules.out
+        node, best = self.node, self.best
+        for ch in text.lower():
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node] < best: best = out[node]
+        changed = best != self.best
+        self.node, self.best = node, best
+        return changed
+
+
+class EyeAnimator:
+    # 眼睛形状按 (表情, 眨眼阶段, 缩放) 预渲染进精灵图集，每帧只做 blit
+    # 眨眼、视线缓动和表情切换的淡入淡出都按单调时钟推进，与帧率无关
+    BLINK_TIME = 0.12  # 一次眨眼的时长 (秒)
+    BLINK_INTERVAL = (2.5, 6.5)  # 两次眨眼的间隔范围 (秒)
+    GAZE_SPEED = 12.0  # 视线缓动速度，越大跟随越快
+    FADE_TIME = 0.25  # 表情颜色过渡时长 (秒)
+
+    def __init__(self):
+        self.atlas = {}
+        now = time.monotonic()
+        self.last = now
+        self.offset = [0.0, 0.0]
+        self.target = (0.0, 0.0)
+        self.phase = 0  # 0 睁眼, 1 半闭, 2 闭眼
+        self.blink_start = None
+        self.next_blink = now + random.uniform(*self.BLINK_INTERVAL)
+        self.emotion = EMOTION_NORMAL
+        self.prev_emotion = EMOTION_NORMAL
+        self.fade_start = now - self.FADE_TIME
+        self.fade = 1.0
+
+    def sprite(self, emotion, phase, scale):
+        key = (emotion, phase, scale)
+        surf = self.atlas.get(key)
+        if surf is None:
+            surf = self.atlas[key] = self.render_sprite(emotion, phase, scale)
+        return surf
+
+    @staticmethod
+    def render_sprite(emotion, phase, scale):
+        c = EMOTION_EYE_COLORS.get(emotion, EYE_COLOR)
+        w, h = round(30 * scale), round(40 * scale)
+        surf = pygame.Surface((w, h), pygame.SRCALPHA)
+        if phase == 2:
+            pygame.draw.rect(surf, c, (0, 20 * scale, w, 4 * scale))
+        elif emotion == EMOTION_HAPPY:
+            pygame.draw.arc(surf, c, (0, 10 * scale, w, 20 * scale), 0, 3.14, 3)
+        elif phase == 1:
+            pygame.draw.ellipse(surf, c, (0, 12 * scale, w, 16 * scale))
+        else:
+            pygame.draw.ellipse(surf, c, (0, 0, w, h))
+        return surf
+
+    def update(self, target, emotion, now=None):
+        now = time.monotonic() if now is None else now
+        dt = min(now - self.last, 0.25)
+        self.last = now
+
+        self.target = target
+        k = 1 - math.exp(-dt * self.GAZE_SPEED)
+        self.offset[0] += (target[0] - self.offset[0]) * k
+        self.offset[1] += (target[1] - self.offset[1]) * k
+
+        if self.blink_start is None and now >= self.next_blink:
+            self.blink_start = now
+        if self.blink_start is not None:
+            t = (now - self.blink_start) / self.BLINK_TIME
+            if t >= 1:
+                self.blink_start = None
+                self.next_blink = now + random.uniform(*self.BLINK_INTERVAL)
+                self.phase = 0
+            else:
+                self.phase = 2 if 0.25 <= t < 0.75 else 1
+
+        if emotion != self.emotion:
+            self.prev_emotion = self.emotion
+            self.emotion = emotion
+            self.fade_start = now
+        self.fade = min(1.0, (now - self.fade_start) / self.FADE_TIME)
+
+    @property
+    def animating(self):
+        return (self.blink_start is not None or self.fade < 1.0
+                or abs(self.offset[0] - self.target[0]) > 0.5 or abs(self.offset[1] - self.target[1]) > 0.5)
+
+    def signature(self):
+        return (round(self.offset[0]), round(self.offset[1]), self.phase, self.emotion, self.prev_emotion,
+                round(self.fade * 10))
+
+    def draw(self, surface, xs, center_y, scale=1.0):
+        ox, oy = round(self.offset[0]), round(self.offset[1])
+        new = self.sprite(self.emotion, self.phase, scale)
+        old = self.sprite(self.prev_emotion, self.phase, scale) if self.fade < 1.0 else None
+        for x in xs:
+            pos = (x - new.get_width() // 2 + ox, center_y - round(20 * scale) + oy)
+            if old is None:
+                surface.blit(new, pos)
+                continue
+            old.set_alpha(round(255 * (1 - self.fade)))
+            new.set_alpha(round(255 * self.fade))
+            surface.blit(old, pos)
+            surface.blit(new, pos)
+            old.set_alpha(None)
+            new.set_alpha(None)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values: return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+class PerfMonitor:
+    # 性能遥测：帧耗时、绘制与排版耗时、事件队列深度，以及每次 API 调用的延迟和数据量
+    # 结果定期追加到 JSONL 指标文件，并可显示在状态栏；关闭时调用方只多一次布尔判断
+    def __init__(self, metrics_path=None, log_interval=5.0, window=300):
+        self.metrics_path = metrics_path
+        self.log_interval = log_interval
+        self.overlay = False
+        self.frame_times = deque(maxlen=window)
+        self.draw_times = deque(maxlen=window)
+        self.event_depths = deque(maxlen=window)
+        self.layout_time = 0.0
+        self.overlay_text = ""
+        self.last_api = None
+        self.last_overlay = self.last_log = time.perf_counter()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        path = None
+        if config.get("metrics_enabled"):
+            path = config.get("metrics_file") or os.path.join(config.get("data_dir", "data"), "metrics.jsonl")
+        return cls(path, log_interval=config.get("metrics_interval", 5.0))
+
+    @property
+    def enabled(self):
+        return self.overlay or self.metrics_path is not None
+
+    def toggle_overlay(self):
+        self.overlay = not self.overlay
+        self.overlay_text = ""
+
+    def add_layout_time(self, seconds):
+        self.layout_time += seconds
+
+    def record_frame(self, frame_start, draw_start, end, event_depth):
+        self.frame_times.append(end - frame_start)
+        self.draw_times.append(end - draw_start)
+        self.event_depths.append(event_depth)
+
+        # 周期性汇总，避免每帧都排序和写文件
+        if self.overlay and end - self.last_overlay >= 0.5:
+            self.last_overlay = end
+            summary = self.frame_summary()
+            api = self.last_api
+            self.overlay_text = (f"f{summary['frame_p95_ms']:.1f} d{summary['draw_p95_ms']:.1f} "
+                                 f"q{summary['event_depth_max']}"
+                                 + (f" api{api['ttfb_ms']:.0f}" if api and "ttfb_ms" in api else ""))
+        if self.metrics_path and end - self.last_log >= self.log_interval:
+            summary = self.frame_summary()
+            summary["layout_ms_per_s"] = round(self.layout_time * 1000 / (end - self.last_log), 3)
+            self.layout_time = 0.0
+            self.last_log = end
+            self.write(summary)
+
+    def frame_summary(self):
+        frames = sorted(self.frame_times)
+        draws = sorted(self.draw_times)
+        return {
+            "type": "frames",
+            "time": time.time(),
+            "frames": len(frames),
+            "frame_p50_ms": round(percentile(frames, 50) * 1000, 3),
+            "frame_p95_ms": round(percentile(frames, 95) * 1000, 3),
+            "frame_p99_ms": round(percentile(frames, 99) * 1000, 3),
+            "draw_p50_ms": round(percentile(draws, 50) * 1000, 3),
+            "draw_p95_ms": round(percentile(draws, 95) * 1000, 3),
+            "event_depth_max": max(self.event_depths, default=0),
+        }
+
+    def record_api(self, record):
+        if not self.enabled: return
+        record = {"type": "api", "time": time.time(), **record}
+        self.last_api = record
+        self.write(record)
+
+    def write(self, record):
+        if not self.metrics_path: return
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.lock:
+            try:
+                os.makedirs(os.path.dirname(self.metrics_path) or ".", exist_ok=True)
+                with open(self.metrics_path, "a", encoding="utf-8") as f:
+                    f.write(line)
+            except OSError:
+                pass
+
+
+class GlyphAdvances(dict):
+    # 字符 -> 前进宽度，没见过的字符第一次用到时向字体查询
+    def __init__(self, font):
+        super().__init__()
+        self.font = font
+
+    def __missing__(self, ch):
+        width = self.font.size(ch)[0]
+        self[ch] = width
+        return width
+
+
+def is_wide(ch):
+    # 中日韩文字及全角符号，任意两个字之间都可以换行
+    return ch >= "\u2e80"
+
+
+class TextLayout:
+    # 用缓存的字形宽度算前缀和，每行用二分找到能放下的最后一个字符，一遍线性扫描完成换行
+    # 拉丁文字在单词边界断行，中日韩文字逐字断行
+    UNSUPPORTED = re.compile("[\U00010000-\U0010FFFF]")
+
+    def __init__(self, font):
+        self.advances = GlyphAdvances(font)
+
+    @classmethod
+    def clean(cls, text):
+        # 字体和 SDL 不支持 BMP 以外的字符 (如 Emoji)，写入时统一替换成空格
+        return cls.UNSUPPORTED.sub(" ", text)
+
+    def breakable(self, text, i):
+        a, b = text[i - 1], text[i]
+        return a == " " or b == " " or is_wide(a) or is_wide(b)
+
+    def wrap(self, text, max_width):
+        lines = []
+        if not text: return lines
+        pos = list(itertools.accumulate(map(self.advances.__getitem__, text), initial=0))
+        start, n = 0, len(text)
+        while start < n:
+            # pos[end] - pos[start] < max_width 的最大 end，至少放一个字符
+            end = max(start + 1, bisect.bisect_left(pos, pos[start] + max_width, start + 1) - 1)
+            if end < n and not self.breakable(text, end):
+                i = end - 1
+                while i > start and not self.breakable(text, i):
+                    i -= 1
+                # 整行只有一个长单词时只能硬断
+                if i > start: end = i
+            lines.append(text[start:end].rstrip(" ") or text[start:end])
+            start = end
+            while start < n and text[start] == " ":
+                start += 1
+        return lines
+
+
+class ChatLayoutCache:
+    # 按消息缓存换行结果和渲染好的 Surface，文字或面板宽度变化时才重建该条
+    def __init__(self, max_entries=LAYOUT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, msg, width, build):
+        key = msg["id"]
+        hit = self.entries.get(key)
+        if hit and hit[0] == msg["text"] and hit[1] == width:
+            self.entries.move_to_end(key)
+            return hit[2]
+        lines = build(msg, width)
+        self.entries[key] = (msg["text"], width, lines)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return lines
+
+    def clear(self):
+        self.entries.clear()
+
 
 class DesktopPetWidget:
     def __init__(self):
-        pygame.init()
+        self.startup = StartupTimer()
+        # 只初始化用到的子系统，跳过音频、手柄等
+        pygame.display.init()
+        pygame.font.init()
         pygame.key.start_text_input()
+        self.startup.mark("pygame")
 
         self.load_config()
+        self.startup.mark("config")
 
         self.state = STATE_IDLE
         self.emotion = EMOTION_NORMAL
@@ -68,38 +1446,90 @@ class DesktopPetWidget:
         self.health = 100
         self.status_icon = ""
 
-        # 初始化屏幕
-        self.screen = pygame.display.set_mode(
+        # 初始化屏幕；每个状态预先分配一块后备画布，绘制都画在画布上再提交到窗口
+        self.display = pygame.display.set_mode(
             (self.current_w, self.current_h),
             pygame.NOFRAME | pygame.SRCALPHA
         )
+        self.backing = {state: pygame.Surface(self.state_size(state), 0, self.display)
+                        for state in (STATE_IDLE, STATE_CHAT, STATE_MINI)}
+        self.screen = self.backing[self.state]
+        self.resize_anim = None
+        self.resize_ms = self.config.get("resize_animation_ms", 0)
         self.clock = pygame.time.Clock()
+        self.scheduler = FrameScheduler(idle_fps=self.config.get("idle_fps", 10))
+        self.startup.mark("display")
 
         # [新增] 窗口控制与置顶状态
         self.window_obj = None
         self.is_pinned = True  # 默认开启置顶
         self.init_window_control()
         self.set_initial_position()
+        self.startup.mark("window")
 
         # 字体
+        self.font_path = self.resolve_font_path()
         self.font = self.load_chinese_font(FONT_SIZE)
         self.status_font = self.load_chinese_font(STATUS_FONT_SIZE)
+        self.text_layout = TextLayout(self.font)
+        self.startup.mark("fonts")
+
+        self.api = BackendPool.from_config(self.config)
+        self.image_pipeline = ImagePipeline.from_config(self.config)
+        self.requests = RequestScheduler.from_config(self.config, self.call_api_thread)
+        self.emotion_rules = EmotionRules.from_config(self.config)
+        self.watcher = ScreenWatcher.from_config(self.config, self.image_pipeline, ready=self.watch_ready)
+        self.control = None
+        self.control_waiters = {}  # 请求 id -> 等待回复的控制连接
+        try:
+            self.control = ControlServer.from_config(self.config, self.image_pipeline)
+        except OSError as e:
+            print(f"控制端口不可用: {e}")
+        self.emotion_scan = None
+        self.response_cache = ResponseCache.from_config(self.config) if self.config.get("cache_enabled") else None
+        self.context_builder = ContextBuilder.from_config(self.config)
+        self.perf = PerfMonitor.from_config(self.config)
+        self.scrap_ready = False
+        self.startup.mark("subsystems")
 
         # 交互数据
         self.dragging = False
         self.drag_offset = (0, 0)
-        self.blink_timer = 0
-        self.is_blinking = False
+        self.eyes = EyeAnimator()
 
         self.user_input = ""
-        self.chat_history = []
-        self.cursor_blink = 0
+        self.chat_history = deque(maxlen=self.config.get("history_size", HISTORY_SIZE))
+        self.msg_ids = itertools.count()
+        self.layout_cache = ChatLayoutCache()
+
+        # 聊天记录持久化与向上翻页
+        self.scrollback = []
+        self.scroll_lines = 0
+        self.chat_log = None
+        self.log_cursor = 0
+        self.log_pending = deque()
+        if self.config.get("chat_log", True):
+            try:
+                self.chat_log = ChatLog(os.path.join(self.config.get("data_dir", "data"), "chat_log.jsonl"))
+                page, self.log_cursor = self.chat_log.read_before(None, HISTORY_LOAD)
+                self.chat_history.extend(self.restore_message(pos, rec) for pos, rec in page)
+            except OSError as e:
+                print(f"聊天记录不可用: {e}")
+                self.chat_log = None
+        self.startup.mark("history")
 
         self.ai_response_buffer = ""
         self.is_typing = False
+        self.is_streaming = False
         self.last_type_time = 0
-
-        self.pending_image_path = None
+        self.type_pos = 0  # 打字机在 ai_response_buffer 中的游标
+        self.type_credit = 0.0  # 累计的可输出字符数 (含小数部分)
+        self.type_skip = False
+        self.typing_msg = None
+        self.type_cps = self.config.get("type_cps", TYPE_CPS)
+        self.type_burst_threshold = self.config.get("type_burst_threshold", TYPE_BURST_THRESHOLD)
+
+        self.pending_image = None
         self.pending_image_surf = None
 
         # 按钮区域
@@ -125,41 +1555,111 @@ class DesktopPetWidget:
                 pass
 
         # 根据新状态设定尺寸
-        if new_state == STATE_MINI:
-            self.current_w = MINI_SIZE
-            self.current_h = MINI_SIZE
-        elif new_state == STATE_IDLE:
-            self.current_w = WIDGET_WIDTH
-            self.current_h = STATUS_BAR_HEIGHT + FACE_HEIGHT
+        old_size = (self.current_w, self.current_h)
+        self.current_w, self.current_h = self.state_size(new_state)
+        if new_state == STATE_IDLE:
             self.user_input = ""
-        elif new_state == STATE_CHAT:
-            self.current_w = WIDGET_WIDTH
-            self.current_h = STATUS_BAR_HEIGHT + FACE_HEIGHT + CHAT_PANEL_HEIGHT
 
-        # 重建窗口
-        self.screen = pygame.display.set_mode(
-            (self.current_w, self.current_h),
-            pygame.NOFRAME | pygame.SRCALPHA
-        )
-        self.init_window_control()
-
-        # 恢复中心位置
-        if old_center and self.window_obj:
-            new_x = int(old_center[0] - self.current_w / 2)
-            new_y = int(old_center[1] - self.current_h / 2)
+        # 切到该状态自己的画布，画布上保留着上次的内容，只需重画签名变化的区域
+        self.screen = self.backing[new_state]
+        self.scheduler.present_all = True
+
+        if old_center and self.resize_ms > 0 and self.window_obj:
+            # 用几帧时间把窗口从旧尺寸过渡到新尺寸，由 run() 逐帧推进
+            self.resize_anim = (time.perf_counter(), old_size, old_center)
+            return
+        self.resize_anim = None
+        self.resize_window((self.current_w, self.current_h), old_center)
+
+    def state_size(self, state):
+        if state == STATE_MINI:
+            return MINI_SIZE, MINI_SIZE
+        if state == STATE_CHAT:
+            return WIDGET_WIDTH, STATUS_BAR_HEIGHT + FACE_HEIGHT + CHAT_PANEL_HEIGHT
+        return WIDGET_WIDTH, STATUS_BAR_HEIGHT + FACE_HEIGHT
+
+    def resize_window(self, size, center=None):
+        # 优先直接修改现有 SDL 窗口的尺寸，避免重建显示造成闪烁；不可用时才回退到 set_mode
+        resized = False
+        if self.window_obj:
+            try:
+                self.window_obj.size = size
+                display = pygame.display.get_surface()
+                if display is not None and display.get_size() == tuple(size):
+                    self.display = display
+                    resized = True
+            except:
+                pass
+        if not resized:
+            self.display = pygame.display.set_mode(size, pygame.NOFRAME | pygame.SRCALPHA)
+            self.init_window_control()
+        self.scheduler.present_all = True
+
+        # 保持窗口中心位置不变
+        if center and self.window_obj:
+            new_x = int(center[0] - size[0] / 2)
+            new_y = int(center[1] - size[1] / 2)
             self.window_obj.position = (new_x, new_y)
 
-    # --- 基础工具 ---
+    def step_resize_animation(self):
+        start, (old_w, old_h), center = self.resize_anim
+        t = min(1.0, (time.perf_counter() - start) * 1000 / self.resize_ms)
+        t = 1 - (1 - t) ** 3  # ease-out
+        size = (round(old_w + (self.current_w - old_w) * t), round(old_h + (self.current_h - old_h) * t))
+        if t >= 1.0:
+            self.resize_anim = None
+            size = (self.current_w, self.current_h)
+        self.resize_window(size, center)
 
-    def add_to_history(self, role, text):
-        self.chat_history.append({"role": role, "text": text})
-        if len(self.chat_history) > 50: self.chat_history.pop(0)
+    # --- 基础工具 ---
 
-    def handle_image_ready(self, surf, path):
-        self.pending_image_path = path
-        w, h = surf.get_size()
-        scale = 50 / h
-        self.pending_image_surf = pygame.transform.scale(surf, (int(w * scale), 50))
+    def add_to_history(self, role, text, **extra):
+        msg = {"id": next(self.msg_ids), "role": role, "text": self.filter_unsupported_chars(text), **extra}
+        self.chat_history.append(msg)
+        if role in ("User", "Bot"): self.persist_message(msg)
+        return msg
+
+    def persist_message(self, msg):
+        # 按 chat_history 的顺序写入：还在生成的 Bot 回复 (pending) 会挡住排在它后面的消息，
+        # 等完整回复到达后再按顺序一起写
+        if not self.chat_log: return
+        self.log_pending.append(msg)
+        self.flush_log()
+
+    def flush_log(self, force=False):
+        while self.log_pending and (force or not self.log_pending[0].get("pending")):
+            msg = self.log_pending.popleft()
+            msg.pop("pending", None)
+            msg["log_pos"] = self.chat_log.append(msg)
+
+    def restore_message(self, pos, rec):
+        return {"id": next(self.msg_ids), "role": rec.get("role", "Sys"),
+                "text": self.filter_unsupported_chars(rec.get("text", "")), "log_pos": pos}
+
+    def oldest_log_pos(self):
+        return min((m["log_pos"] for m in itertools.chain(self.scrollback, self.chat_history)
+                    if m.get("log_pos") is not None), default=self.log_cursor)
+
+    def load_older_messages(self):
+        # 从聊天记录文件中再往前读一页，放到翻页缓冲最前面，返回读到的条数
+        if not self.chat_log or len(self.scrollback) >= SCROLLBACK_LIMIT: return 0
+        end = self.oldest_log_pos()
+        if end <= 0: return 0
+        try:
+            page, _ = self.chat_log.read_before(end, SCROLLBACK_PAGE)
+        except OSError:
+            return 0
+        self.scrollback[:0] = [self.restore_message(pos, rec) for pos, rec in page]
+        return len(page)
+
+    def scroll_chat(self, lines):
+        self.scroll_lines = max(0, self.scroll_lines + lines)
+        if self.scroll_lines == 0:
+            self.scrollback.clear()
+
+    def handle_image_ready(self, image):
+        self.pending_image = image
+        self.pending_image_surf = image["surf"]
         if self.state != STATE_CHAT:
             self.switch_state(STATE_CHAT)
 
@@ -173,24 +1673,41 @@ class DesktopPetWidget:
                 pass
 
     def load_config(self):
+        self.config = read_config()
+
+    def resolve_font_path(self):
+        # 上次探测到的字体路径缓存在 data_dir 下，避免每次启动都扫描系统字体
+        cache_path = os.path.join(self.config.get("data_dir", "data"), "font_cache.json")
         try:
-            with open("config.json", "r", encoding='utf-8') as f:
-                self.config = json.load(f)
-        except:
-            self.config = {"api_key": "", "api_url": "", "model": "qwen-vl-plus"}
+            with open(cache_path, "r", encoding="utf-8") as f:
+                path = json.load(f).get("path")
+            if path and os.path.exists(path): return path
+        except (OSError, ValueError):
+            pass
+
+        path = None
+        for p in FONT_CANDIDATES.get(platform.system(), []) + ["font.ttf"]:
+            if os.path.exists(p):
+                path = os.path.abspath(p)
+                break
+        if path is None:
+            path = pygame.font.match_font("arial")
+        try:
+            os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+            with open(cache_path, "w", encoding="utf-8") as f:
+                json.dump({"path": path}, f)
+        except OSError:
+            pass
+        return path
 
     def load_chinese_font(self, size):
-        system = platform.system()
-        if system == 'Darwin':
-            fonts = ["/System/Library/Fonts/PingFang.ttc", "/System/Library/Fonts/STHeiti Light.ttc"]
-            for p in fonts:
-                if os.path.exists(p): return pygame.font.Font(p, size)
-        elif system == 'Windows':
-            fonts = ["C:\\Windows\\Fonts\\msyh.ttc", "C:\\Windows\\Fonts\\simhei.ttf"]
-            for p in fonts:
-                if os.path.exists(p): return pygame.font.Font(p, size)
-        if os.path.exists("font.ttf"): return pygame.font.Font("font.ttf", size)
-        return pygame.font.SysFont("Arial", size)
+        # 直接按路径打开，由 FreeType 按需读取字体表，不把整个字体文件读进内存
+        if self.font_path:
+            try:
+                return pygame.font.Font(self.font_path, size)
+            except (OSError, pygame.error):
+                pass
+        return pygame.font.Font(None, size)
 
     def init_window_control(self):
         if Window:
@@ -203,101 +1720,141 @@ class DesktopPetWidget:
                 pass
 
     def wrap_text_dynamic(self, text, max_width):
-        lines = []
-        if not text: return lines
-        curr = ""
-        for char in text:
-            if self.font.size(curr + char)[0] < max_width:
-                curr += char
-            else:
-                lines.append(curr)
-                curr = char
-        if curr: lines.append(curr)
-        return lines
+        return self.text_layout.wrap(text, max_width)
 
     def filter_unsupported_chars(self, text):
-        return "".join([c if ord(c) < 0x10000 else " " for c in text])
+        return TextLayout.clean(text)
+
+    def begin_typing(self, text=""):
+        # 新建一条 Bot 消息，打字机从 text 的开头开始输出；上一条还没打完的直接补全
+        if self.is_typing: self.finish_typing()
+        self.ai_response_buffer = text
+        self.type_pos = 0
+        self.type_credit = 0.0
+        self.type_skip = False
+        self.last_type_time = ticks_ms()
+        self.typing_msg = self.add_to_history("Bot", "", pending=True)
+        self.is_typing = True
+
+    def skip_typewriter(self):
+        # 直接把当前回复打完，后续流式到达的内容也立即显示
+        if self.is_typing: self.type_skip = True
 
     def update_typewriter(self):
-        if self.is_typing and self.ai_response_buffer:
-            if pygame.time.get_ticks() - self.last_type_time > 30:
-                c = self.ai_response_buffer[0]
-                self.ai_response_buffer = self.ai_response_buffer[1:]
-                if self.chat_history and self.chat_history[-1]["role"] == "Bot":
-                    self.chat_history[-1]["text"] += c
-                else:
-                    self.chat_history.append({"role": "Bot", "text": c})
-                self.last_type_time = pygame.time.get_ticks()
-                if not self.ai_response_buffer:
-                    self.is_typing = False
-                    self.emotion = EMOTION_NORMAL
-                    self.status_icon = ""
+        if not self.is_typing: return
+        now = ticks_ms()
+        dt = (now - self.last_type_time) / 1000
+        self.last_type_time = now
+
+        buf = self.ai_response_buffer
+        backlog = len(buf) - self.type_pos
+        if backlog > 0:
+            # 按经过的时间输出字符，积压过多时提速，长回复的总耗时只随长度对数增长
+            rate = self.type_cps
+            if backlog > self.type_burst_threshold:
+                rate = max(rate, backlog / TYPE_CATCHUP_SECONDS)
+            self.type_credit += dt * rate
+            n = backlog if self.type_skip else min(backlog, int(self.type_credit))
+            if n > 0:
+                self.type_credit = max(0.0, self.type_credit - n)
+                self.typing_msg["text"] += buf[self.type_pos:self.type_pos + n]
+                self.type_pos += n
+        elif self.is_streaming:
+            # 等待流式内容时不积累额度，避免下一块到达时一下子全部涌出
+            self.type_credit = 0.0
+        else:
+            self.finish_typing()
+            self.emotion = EMOTION_NORMAL
+            self.status_icon = ""
+
+    def finish_typing(self):
+        self.typing_msg["text"] += self.ai_response_buffer[self.type_pos:]
+        self.is_typing = False
+        self.ai_response_buffer = ""
+        self.type_pos = 0
+        self.typing_msg["pending"] = False
+        self.flush_log()
 
     def analyze_emotion(self, text):
-        t = text.lower()
-        self.status_icon = ""
-        if any(k in t for k in ["哈哈", "开心", "成功"]):
-            self.emotion = EMOTION_HAPPY
-            self.health = min(100, self.health + 1)
-        elif any(k in t for k in ["错误", "error", "失败"]):
-            self.emotion = EMOTION_ANGRY
-            self.status_icon = "!"
-            self.health = max(0, self.health - 2)
-        elif any(k in t for k in ["思考", "thinking"]):
-            self.emotion = EMOTION_THINKING
-            self.status_icon = "?"
-        else:
+        scan = self.emotion_rules.scanner()
+        scan.feed(text)
+        self.apply_emotion(scan.rule, final=True)
+
+    def apply_emotion(self, rule, final=False):
+        # 回复进行中只切换表情，回复结束时 (final) 才结算血量
+        if rule is None:
             self.emotion = EMOTION_NORMAL
+            self.status_icon = ""
+        else:
+            self.emotion = rule["emotion"]
+            self.status_icon = rule.get("icon", "")
+            if final: self.health = max(0, min(100, self.health + rule.get("hp", 0)))
 
     # --- 绘图逻辑 ---
 
-    def draw_eyes(self, surface, center_y, scale=1.0):
+    def layout_message(self, msg, width):
+        if self.perf.enabled: t = time.perf_counter()
+        col = USER_COLOR if msg["role"] == "User" else BOT_COLOR
+        if msg["role"] == "System": col = (100, 100, 100)
+        raw = f"{msg['role']}: {msg['text']}"
+        lines = [self.font.render(l, True, col) for l in self.wrap_text_dynamic(raw, width)]
+        if self.perf.enabled: self.perf.add_layout_time(time.perf_counter() - t)
+        return lines
+
+    def update_eyes(self):
+        # 每帧推进眼睛动画，结果同时用于脏区判断和绘制
         mx, my = pygame.mouse.get_pos()
         if self.state == STATE_MINI and self.window_obj:
             wx, wy = self.window_obj.position
             mx = mx - wx
             my = my - wy
-
-        lx, rx = self.current_w // 3, self.current_w * 2 // 3
+        center_y = MINI_SIZE // 2 if self.state == STATE_MINI else STATUS_BAR_HEIGHT + FACE_HEIGHT // 2
         ox = max(-8, min(8, (mx - self.current_w / 2) / 15))
         oy = max(-8, min(8, (my - center_y) / 15))
+        self.eyes.update((ox, oy), self.emotion)
 
-        self.blink_timer -= 1
-        if self.blink_timer <= 0:
-            self.is_blinking = not self.is_blinking
-            self.blink_timer = 5 if self.is_blinking else random.randint(150, 400)
-
-        c = EYE_COLOR
-        if self.emotion == EMOTION_ANGRY:
-            c = (255, 50, 50)
-        elif self.emotion == EMOTION_THINKING:
-            c = (255, 200, 0)
-        elif self.emotion == EMOTION_HAPPY:
-            c = (50, 255, 100)
-
-        eye_w, eye_h = 30 * scale, 40 * scale
+    def draw_eyes(self, surface, center_y, scale=1.0):
+        self.eyes.draw(surface, (self.current_w // 3, self.current_w * 2 // 3), center_y, scale)
 
-        if self.is_blinking:
-            pygame.draw.rect(surface, c, (lx - eye_w / 2, center_y + oy, eye_w, 4 * scale))
-            pygame.draw.rect(surface, c, (rx - eye_w / 2, center_y + oy, eye_w, 4 * scale))
-        else:
-            if self.emotion == EMOTION_HAPPY:
-                pygame.draw.arc(surface, c, (lx - eye_w / 2 + ox, center_y - 10 * scale + oy, eye_w, 20 * scale), 0,
-                                3.14, 3)
-                pygame.draw.arc(surface, c, (rx - eye_w / 2 + ox, center_y - 10 * scale + oy, eye_w, 20 * scale), 0,
-                                3.14, 3)
-            else:
-                pygame.draw.ellipse(surface, c, (lx - eye_w / 2 + ox, center_y - 20 * scale + oy, eye_w, eye_h))
-                pygame.draw.ellipse(surface, c, (rx - eye_w / 2 + ox, center_y - 20 * scale + oy, eye_w, eye_h))
+    def chat_layout(self):
+        # 返回 (聊天区顶部 y, 输入区顶部 y, 输入区高度)
+        input_h = 50 + (60 if self.pending_image_surf else 0)
+        return STATUS_BAR_HEIGHT + FACE_HEIGHT, self.current_h - input_h, input_h
 
-    def draw_normal_window(self):
-        # 1. 绘制不透明的身体部分
+    def frame_regions(self):
+        # 各区域: (名称, 矩形, 内容签名, 绘制函数)，签名不变的区域本帧不重绘
+        w = self.current_w
+        eyes = self.eyes.signature()
+        if self.state == STATE_MINI:
+            return [("mini", pygame.Rect(0, 0, w, self.current_h), eyes, self.draw_mini_ball)]
+
+        regions = [
+            ("status", pygame.Rect(0, 0, w, STATUS_BAR_HEIGHT + 1),
+             (self.level, self.health, self.emotion, self.status_icon, self.is_pinned, self.perf.overlay_text),
+             self.draw_status_bar),
+            ("face", pygame.Rect(0, STATUS_BAR_HEIGHT + 1, w, FACE_HEIGHT - 1), eyes, self.draw_face),
+        ]
+        if self.state == STATE_CHAT:
+            chat_y, iy, input_h = self.chat_layout()
+            last = self.chat_history[-1] if self.chat_history else None
+            chat_sig = (input_h, len(self.chat_history), last and last["id"], last and len(last["text"]),
+                        self.type_pos, self.scroll_lines, len(self.scrollback))
+            cursor_on = (ticks_ms() // 500) % 2 == 0
+            input_sig = (input_h, id(self.pending_image_surf), self.user_input, cursor_on)
+            regions.append(("chat", pygame.Rect(0, chat_y, w, iy - chat_y), chat_sig, self.draw_chat_history))
+            regions.append(("input", pygame.Rect(0, iy, w, input_h), input_sig, self.draw_input_line))
+        return regions
+
+    def draw_body(self):
+        # 不透明的身体部分，由各区域在自己的裁剪范围内重画
         body_rect = pygame.Rect(0, STATUS_BAR_HEIGHT, self.current_w, self.current_h - STATUS_BAR_HEIGHT)
         pygame.draw.rect(self.screen, BODY_BG_COLOR, body_rect)
         pygame.draw.rect(self.screen, (60, 60, 70), body_rect, 1)
 
-        # 2. 绘制半透明状态栏
-        status_rect = pygame.Rect(0, 0, self.current_w, STATUS_BAR_HEIGHT)
+    def draw_status_bar(self):
+        self.draw_body()
+
+        # 半透明状态栏
         status_surf = pygame.Surface((self.current_w, STATUS_BAR_HEIGHT), pygame.SRCALPHA)
         status_surf.fill(STATUS_BG_COLOR)
 
@@ -309,7 +1866,11 @@ class DesktopPetWidget:
             self.status_font.render(f"HP: {self.health}%", True,
                                     (50, 255, 100) if self.health > 30 else (255, 50, 50)),
             (60, 8))
-        status_surf.blit(self.status_font.render(f"Mood: {mood_txt}", True, STATUS_TEXT_COLOR), (140, 8))
+        if self.perf.overlay:
+            # 调试浮层：帧耗时 p95 / 绘制耗时 p95 / 事件队列深度 / 最近一次 API 首字节延迟
+            status_surf.blit(self.status_font.render(self.perf.overlay_text, True, (255, 200, 0)), (140, 8))
+        else:
+            status_surf.blit(self.status_font.render(f"Mood: {mood_txt}", True, STATUS_TEXT_COLOR), (140, 8))
 
         # 最小化按钮 [-]
         btn_x = self.current_w - 30
@@ -340,44 +1901,57 @@ class DesktopPetWidget:
         self.screen.blit(status_surf, (0, 0))
         pygame.draw.line(self.screen, (50, 50, 60), (0, STATUS_BAR_HEIGHT), (self.current_w, STATUS_BAR_HEIGHT), 1)
 
-        # 3. 绘制眼睛
+    def draw_face(self):
+        self.draw_body()
         self.draw_eyes(self.screen, STATUS_BAR_HEIGHT + FACE_HEIGHT // 2)
 
-        # 4. 绘制聊天面板
-        if self.state == STATE_CHAT:
-            chat_y = STATUS_BAR_HEIGHT + FACE_HEIGHT
-            pygame.draw.line(self.screen, (50, 50, 50), (10, chat_y), (self.current_w - 10, chat_y), 1)
-
-            input_h = 50 + (60 if self.pending_image_surf else 0)
-            hist_h = CHAT_PANEL_HEIGHT - input_h - 10
-
-            lines = []
-            for m in self.chat_history:
-                col = USER_COLOR if m["role"] == "User" else BOT_COLOR
-                if m["role"] == "System": col = (100, 100, 100)
-                raw = f"{m['role']}: {self.filter_unsupported_chars(m['text'])}"
-                for l in self.wrap_text_dynamic(raw, self.current_w - 30): lines.append((l, col))
-
-            vis = lines[-(hist_h // (FONT_SIZE + 6)):] if len(lines) > 0 else []
-            cy = chat_y + 10
-            for t, c in vis:
-                self.screen.blit(self.font.render(t, True, c), (15, cy))
-                cy += FONT_SIZE + 6
-
-            iy = self.current_h - input_h
-            pygame.draw.line(self.screen, (40, 40, 45), (0, iy), (self.current_w, iy))
-            if self.pending_image_surf:
-                self.screen.blit(self.pending_image_surf, (15, iy + 5))
-                iy += 60
-
-            cursor = "_" if (self.cursor_blink // 30) % 2 == 0 else ""
-            self.cursor_blink += 1
-            prompt = f"> {self.filter_unsupported_chars(self.user_input)}{cursor}"
-            self.screen.blit(self.font.render(prompt, True, TEXT_COLOR), (15, iy + 15))
-            try:
-                pygame.key.set_text_input_rect(pygame.Rect(15, iy + 30, 200, 50))
-            except:
-                pass
+    def draw_chat_history(self):
+        self.draw_body()
+        chat_y, iy, input_h = self.chat_layout()
+        pygame.draw.line(self.screen, (50, 50, 50), (10, chat_y), (self.current_w - 10, chat_y), 1)
+        hist_h = CHAT_PANEL_HEIGHT - input_h - 10
+
+        # 从最新消息往回取，只排版到可见窗口为止，未变化的消息直接复用缓存
+        # 向上滚动超出内存中的消息时，再从聊天记录文件按页补读
+        max_lines = hist_h // LINE_HEIGHT
+        want = max_lines + self.scroll_lines
+        msgs = self.scrollback + list(self.chat_history)
+        i, count, chunks = len(msgs), 0, []
+        while count < want:
+            if i == 0:
+                i = self.load_older_messages()
+                if not i: break
+                msgs = self.scrollback
+                continue
+            i -= 1
+            lines = self.layout_cache.get(msgs[i], self.current_w - 30, self.layout_message)
+            chunks.append(lines)
+            count += len(lines)
+        if count < want:
+            # 已经到最早的记录
+            self.scroll_lines = max(0, count - max_lines)
+        vis = [l for lines in reversed(chunks) for l in lines]
+        end = len(vis) - self.scroll_lines
+        cy = chat_y + 10
+        for surf in vis[max(0, end - max_lines):end] if max_lines > 0 else []:
+            self.screen.blit(surf, (15, cy))
+            cy += LINE_HEIGHT
+
+    def draw_input_line(self):
+        self.draw_body()
+        chat_y, iy, input_h = self.chat_layout()
+        pygame.draw.line(self.screen, (40, 40, 45), (0, iy), (self.current_w, iy))
+        if self.pending_image_surf:
+            self.screen.blit(self.pending_image_surf, (15, iy + 5))
+            iy += 60
+
+        cursor = "_" if (ticks_ms() // 500) % 2 == 0 else ""
+        prompt = f"> {self.user_input}{cursor}"
+        self.screen.blit(self.font.render(prompt, True, TEXT_COLOR), (15, iy + 15))
+        try:
+            pygame.key.set_text_input_rect(pygame.Rect(15, iy + 30, 200, 50))
+        except:
+            pass
 
     def draw_mini_ball(self):
         center = (MINI_SIZE // 2, MINI_SIZE // 2)
@@ -386,74 +1960,306 @@ class DesktopPetWidget:
         pygame.draw.circle(self.screen, EYE_COLOR, center, radius, 2)
         self.draw_eyes(self.screen, center[1], scale=0.6)
 
+    def draw_dirty(self):
+        # 只重画内容变化的区域并拷贝到窗口，返回需要提交到屏幕的矩形
+        rects = []
+        for name, rect, sig, draw_fn in self.scheduler.collect(self.frame_regions(), self.state):
+            self.screen.set_clip(rect)
+            self.screen.fill((0, 0, 0, 0), rect)
+            draw_fn()
+            rects.append(rect)
+        self.screen.set_clip(None)
+
+        if self.scheduler.present_all:
+            # 切换状态或调整窗口后整块提交一次
+            self.scheduler.present_all = False
+            self.display.fill((0, 0, 0))
+            self.display.blit(self.screen, (0, 0))
+            return [self.display.get_rect()]
+        for rect in rects:
+            self.display.blit(self.screen, rect, rect)
+        return rects
+
     def draw(self):
-        self.screen.fill((0, 0, 0, 0))
-        if self.state == STATE_MINI:
-            self.draw_mini_ball()
-        else:
-            self.draw_normal_window()
+        # 整窗重绘
+        self.scheduler.invalidate(self.state)
+        return self.draw_dirty()
 
     # --- 线程 ---
-    def call_api_thread(self, prompt, image_path):
+    def start_reply(self, reply):
+        self.analyze_emotion(reply)
+        self.begin_typing(self.filter_unsupported_chars(reply))
+
+    def call_api_thread(self, req):
+        # 在请求调度器的工作线程里运行：只发请求、投递事件，不直接修改界面状态
+        emit = self.requests.emit
+        prompt, image, cancel = req["prompt"], req["image"], req["cancel"]
+        started = time.perf_counter()
+        metrics = {"request_id": req["id"], "model": self.config.get("model"),
+                   "stream": bool(self.config.get("stream")), "image_bytes": len(image["data"]) if image else 0}
         try:
-            msgs = [{"role": "system", "content": self.config.get("system_prompt", "")}]
-            if image_path:
-                with open(image_path, "rb") as f:
-                    b64 = base64.b64encode(f.read()).decode()
-                msgs.append({"role": "user", "content": [{"type": "text", "text": prompt or "图里有什么"},
-                                                         {"type": "image_url",
-                                                          "image_url": {"url": f"data:image/png;base64,{b64}"}}]})
+            msgs = build_messages(self.config, self.context_builder, prompt, image, req.get("history", ()))
+            emit(req, "start")
+
+            cache_key = None
+            if self.response_cache:
+                cache_key = ResponseCache.make_key(self.config.get("model"), msgs)
+                reply = self.response_cache.get(cache_key)
+                if reply is not None:
+                    # 命中缓存，直接交给打字机
+                    emit(req, "reply", reply)
+                    emit(req, "done", reply)
+                    metrics["cache_hit"] = True
+                    return
+
+            payload = {"model": self.config.get("model"), "messages": msgs}
+            stream = self.config.get("stream", False)
+            if stream: payload["stream"] = True
+
+            with self.api.post(payload, cancel) as res:
+                req["response"] = res
+                if cancel.is_set(): raise RequestCancelled()
+                metrics["backend"] = res.backend.name
+                metrics["model"] = res.backend.model
+                metrics["ttfb_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                metrics["request_bytes"] = res.request_bytes
+                if stream and "text/event-stream" in res.getheader("Content-Type", ""):
+                    # 流式：每收到一块就投递给主循环的打字机
+                    reply = ""
+                    for chunk in iter_sse_content(res):
+                        if cancel.is_set(): break
+                        if not reply:
+                            metrics["first_token_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                        reply += chunk
+                        emit(req, "chunk", chunk)
+                    if cancel.is_set(): raise RequestCancelled()
+                else:
+                    # 非流式 (或服务端不支持 stream) 时的回退路径
+                    js = json.loads(res.read().decode())
+                    reply = js['choices'][0]['message']['content']
+                    if cancel.is_set(): raise RequestCancelled()
+                    emit(req, "reply", reply)
+            emit(req, "done", reply)
+            metrics["response_bytes"] = res.bytes_read
+            metrics["reply_chars"] = len(reply)
+            if cache_key and reply:
+                self.response_cache.put(cache_key, reply)
+        except Exception as e:
+            # 取消时 socket 被关掉，读取会以各种异常结束，统一按取消处理
+            if cancel.is_set():
+                emit(req, "cancelled")
+                metrics["cancelled"] = True
             else:
-                msgs.append({"role": "user", "content": prompt})
-
-            self.emotion = EMOTION_THINKING
-            self.status_icon = "?"
-
-            req = urllib.request.Request(
-                self.config.get("api_url"),
-                data=json.dumps({"model": self.config.get("model"), "messages": msgs}).encode(),
-                headers={"Content-Type": "application/json", "Authorization": f"Bearer {self.config.get('api_key')}"}
-            )
-            with urllib.request.urlopen(req) as res:
-                js = json.loads(res.read().decode())
-                reply = js['choices'][0]['message']['content']
-                self.analyze_emotion(reply)
-                self.ai_response_buffer = reply
-                self.is_typing = True
-                self.chat_history.append({"role": "Bot", "text": ""})
+                emit(req, "error", str(e))
+                metrics["error"] = str(e)
+        finally:
+            req["response"] = None
+            if self.perf.enabled:
+                metrics["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                self.perf.record_api(metrics)
+
+    def poll_requests(self):
+        # 处理请求调度器投递的事件：情绪、聊天记录、打字机缓冲和等级只在主线程修改
+        for req_id, kind, data in self.requests.poll():
+            client = self.control_waiters.get(req_id)
+            if client:
+                event = {"id": req_id, "event": kind}
+                if data is not None: event["text"] = data
+                client.send(event)
+                if kind in ("done", "cancelled", "error"):
+                    del self.control_waiters[req_id]
+                    client.finish()
+            if kind == "start":
+                self.emotion = EMOTION_THINKING
+                self.status_icon = "?"
+            elif kind == "chunk":
+                if not self.is_streaming:
+                    self.begin_typing()
+                    self.typing_msg["req"] = req_id
+                    self.is_streaming = True
+                    self.emotion_scan = self.emotion_rules.scanner()
+                self.ai_response_buffer += self.filter_unsupported_chars(data)
+                # 边收边匹配，命中更靠前的规则时立即换表情
+                if self.emotion_scan.feed(data): self.apply_emotion(self.emotion_scan.rule)
+            elif kind == "reply":
+                self.start_reply(data)
+                self.typing_msg["req"] = req_id
+            elif kind == "done":
+                if self.is_streaming:
+                    self.is_streaming = False
+                    self.apply_emotion(self.emotion_scan.rule, final=True)
+                if self.typing_msg and self.typing_msg.get("req") == req_id:
+                    # 完整回复已到，不必等打字机打完就可以写入聊天记录
+                    self.typing_msg["reply"] = data
+                    self.typing_msg["pending"] = False
+                    self.flush_log()
                 self.level += 1
-        except Exception as e:
-            self.add_to_history("Sys", f"Err: {e}")
-            self.emotion = EMOTION_ANGRY
-            self.status_icon = "!"
-        if image_path and "temp" in image_path:
-            try:
-                os.remove(image_path)
-            except:
-                pass
+            elif kind == "cancelled":
+                if self.is_streaming:
+                    # 丢掉还没打出来的部分
+                    self.is_streaming = False
+                    self.ai_response_buffer = self.ai_response_buffer[:self.type_pos]
+                self.add_to_history("Sys", "已取消")
+                self.emotion = EMOTION_NORMAL
+                self.status_icon = ""
+            elif kind == "error":
+                self.is_streaming = False
+                self.add_to_history("Sys", f"Err: {data}")
+                self.emotion = EMOTION_ANGRY
+                self.status_icon = "!"
+
+    def send_message(self):
+        t, i = self.user_input, self.pending_image
+        if self.send_prompt(t, i, t + (" [IMG]" if i else "")) is None: return
+        self.user_input = ""
+        self.pending_image = None
+        self.pending_image_surf = None
+
+    def send_prompt(self, prompt, image, label):
+        # 排队已满时返回 None，调用方保留输入内容，提示稍后再发
+        if self.requests.full():
+            self.add_to_history("Sys", "还有请求在排队，请稍候")
+            return None
+        history = list(self.chat_history)
+        self.add_to_history("User", label, prompt=prompt, image=image)
+        self.scroll_chat(-self.scroll_lines)
+        req = self.requests.submit(prompt=prompt, image=image, history=history)
+        if req is None: self.add_to_history("Sys", "还有请求在排队，请稍候")
+        return req
 
     def handle_paste(self):
         try:
+            # PIL 只在第一次粘贴时导入
+            from PIL import Image, ImageGrab
             img = ImageGrab.grabclipboard()
             if isinstance(img, Image.Image):
-                path = os.path.join(os.getcwd(), "temp_clipboard.png")
-                img.save(path)
-                mode, size, data = img.mode, img.size, img.tobytes()
-                py_img = pygame.image.fromstring(data, size, mode)
-                self.handle_image_ready(py_img, path)
+                self.image_pipeline.submit(img)
+                return
+            # 复制的是图片文件时剪贴板里是路径列表
+            if isinstance(img, list) and img and os.path.isfile(img[0]):
+                self.image_pipeline.submit(img[0])
                 return
         except:
             pass
+        if not self.scrap_ready:
+            pygame.scrap.init()
+            self.scrap_ready = True
         t = pygame.scrap.get(pygame.SCRAP_TEXT)
-        if t: self.user_input += t.decode('utf-8').strip('\x00')
+        if t: self.user_input += self.filter_unsupported_chars(t.decode('utf-8').strip('\x00'))
+
+    def report_startup(self):
+        report = self.startup.report()
+        if self.config.get("startup_report"):
+            phases = ", ".join(f"{name} {ms:.1f}ms" for name, ms in report["phases"].items())
+            print(f"启动耗时 {report['total_ms']:.1f}ms: {phases}")
+        self.perf.write(report)
+
+    def poll_image_pipeline(self):
+        while True:
+            try:
+                result = self.image_pipeline.results.get_nowait()
+            except queue.Empty:
+                return
+            if isinstance(result, Exception):
+                self.add_to_history("Sys", f"Err: {result}")
+            else:
+                self.handle_image_ready(result)
+
+    def watch_ready(self):
+        # 在观察线程里调用，只读状态
+        return not self.requests.busy and not self.is_typing
+
+    def toggle_watch(self):
+        on = self.watcher.toggle()
+        self.add_to_history("Sys", "屏幕观察已开启" if on else "屏幕观察已关闭")
+
+    def poll_screen_watch(self):
+        while True:
+            try:
+                frame = self.watcher.frames.get_nowait()
+            except queue.Empty:
+                return
+            if isinstance(frame, Exception):
+                self.add_to_history("Sys", f"Err: {frame}")
+                self.add_to_history("Sys", "屏幕观察已关闭")
+            else:
+                self.send_prompt(self.config.get("watch_prompt", "这是我现在的屏幕，简短评论一下"), frame, "[屏幕]")
+
+    def status(self):
+        info = {"state": self.state, "emotion": self.emotion, "level": self.level, "health": self.health,
+                "busy": self.requests.busy, "queued": self.requests.jobs.qsize(), "watching": self.watcher.enabled,
+                "backends": self.api.status()}
+        if self.response_cache: info["cache"] = self.response_cache.stats()
+        if self.perf.enabled:
+            info["frames"] = self.perf.frame_summary()
+            info["last_api"] = self.perf.last_api
+        return info
+
+    def poll_control(self):
+        # 在主线程执行控制连接发来的命令
+        while True:
+            try:
+                client, cmd = self.control.commands.get_nowait()
+            except queue.Empty:
+                return
+            self.scheduler.poke(ticks_ms())
+            try:
+                self.run_control_command(client, cmd)
+            finally:
+                client.finish()
+
+    def run_control_command(self, client, cmd):
+        name = cmd["cmd"]
+        if name == "prompt":
+            text, image = cmd.get("text", ""), cmd.get("image_data")
+            if not text.strip() and not image:
+                client.send({"ok": False, "error": "缺少 text 或 image"})
+                return
+            req = self.send_prompt(text, image, text + (" [IMG]" if image else ""))
+            if req is None:
+                client.send({"ok": False, "error": "请求排队已满"})
+            else:
+                # 连接要等这个请求结束后才算答复完
+                self.control_waiters[req["id"]] = client
+                client.begin()
+                client.send({"ok": True, "id": req["id"], "event": "queued"})
+        elif name == "image":
+            # 和拖入图片一样放进输入框，等用户补充文字后发送
+            if "image_data" not in cmd:
+                client.send({"ok": False, "error": "缺少 image"})
+                return
+            self.handle_image_ready(cmd["image_data"])
+            client.send({"ok": True})
+        elif name == "state":
+            if cmd.get("state") not in (STATE_IDLE, STATE_CHAT, STATE_MINI):
+                client.send({"ok": False, "error": f"未知状态: {cmd.get('state')}"})
+                return
+            self.switch_state(cmd["state"])
+            client.send({"ok": True, "state": self.state})
+        elif name == "cancel":
+            req_id = self.requests.cancel(cmd.get("id"))
+            if req_id is None:
+                client.send({"ok": False, "error": "没有可取消的请求"})
+            else:
+                client.send({"ok": True, "id": req_id})
+        elif name == "status":
+            client.send({"ok": True, **self.status()})
+        else:
+            client.send({"ok": False, "error": f"未知命令: {name}"})
 
     def run(self):
         running = True
-        pygame.scrap.init()
         last_click_time = 0
+        first_frame = True
 
         while running:
+            perf = self.perf.enabled
+            if perf: frame_start = time.perf_counter()
             self.update_typewriter()
+            self.poll_image_pipeline()
+            self.poll_requests()
+            self.poll_screen_watch()
+            if self.control: self.poll_control()
             events = pygame.event.get()
 
             for event in events:
@@ -463,7 +2269,7 @@ class DesktopPetWidget:
                 elif event.type == pygame.MOUSEBUTTONDOWN:
                     if event.button == 1:
                         if self.state == STATE_MINI:
-                            now = pygame.time.get_ticks()
+                            now = ticks_ms()
                             if now - last_click_time < 500:
                                 self.switch_state(STATE_IDLE)
                                 last_click_time = 0
@@ -490,6 +2296,9 @@ class DesktopPetWidget:
                 elif event.type == pygame.MOUSEBUTTONUP:
                     if event.button == 1: self.dragging = False
 
+                elif event.type == pygame.MOUSEWHEEL and self.state == STATE_CHAT:
+                    self.scroll_chat(event.y * SCROLL_STEP)
+
                 elif event.type == pygame.MOUSEMOTION:
                     if self.dragging and self.window_obj:
                         mx, my = event.pos
@@ -500,11 +2309,7 @@ class DesktopPetWidget:
 
                 elif event.type == pygame.DROPFILE:
                     if os.path.exists(event.file):
-                        try:
-                            img = pygame.image.load(event.file)
-                            self.handle_image_ready(img, event.file)
-                        except:
-                            pass
+                        self.image_pipeline.submit(event.file)
 
                 elif event.type == pygame.KEYDOWN:
                     is_ctrl = (event.mod & pygame.KMOD_CTRL) or (event.mod & pygame.KMOD_META)
@@ -521,26 +2326,155 @@ class DesktopPetWidget:
                         if self.state == STATE_CHAT:
                             if event.key == pygame.K_v and is_ctrl:
                                 self.handle_paste()
+                            elif event.key == pygame.K_TAB:
+                                self.skip_typewriter()
+                            elif event.key == pygame.K_c and is_ctrl:
+                                self.requests.cancel()
                             elif event.key == pygame.K_RETURN:
-                                if self.user_input.strip() or self.pending_image_path:
-                                    t, i = self.user_input, self.pending_image_path
-                                    self.add_to_history("User", t + (" [IMG]" if i else ""))
-                                    self.user_input = ""
-                                    self.pending_image_path = None
-                                    self.pending_image_surf = None
-                                    threading.Thread(target=self.call_api_thread, args=(t, i)).start()
+                                if self.user_input.strip() or self.pending_image:
+                                    self.send_message()
                             elif event.key == pygame.K_BACKSPACE:
                                 self.user_input = self.user_input[:-1]
 
-                elif event.type == pygame.TEXTINPUT and self.state == STATE_CHAT:
-                    self.user_input += event.text
+                        if event.key == pygame.K_F3:
+                            self.perf.toggle_overlay()
+                        elif event.key == pygame.K_F2:
+                            self.toggle_watch()
 
-            self.draw()
-            pygame.display.flip()
-            self.clock.tick(60)
+                elif event.type == pygame.TEXTINPUT and self.state == STATE_CHAT:
+                    self.user_input += self.filter_unsupported_chars(event.text)
+
+            now = ticks_ms()
+            if events: self.scheduler.poke(now)
+            if self.resize_anim: self.step_resize_animation()
+            self.update_eyes()
+            if perf: draw_start = time.perf_counter()
+            rects = self.draw_dirty()
+            if rects: pygame.display.update(rects)
+            if first_frame:
+                first_frame = False
+                self.startup.mark("first_frame")
+                self.report_startup()
+            if perf: self.perf.record_frame(frame_start, draw_start, time.perf_counter(), len(events))
+            animating = (self.is_typing or self.dragging or self.eyes.animating or self.resize_anim is not None
+                         or self.requests.busy)
+            self.clock.tick(self.scheduler.fps(now, animating))
+        self.api.close()
+        if self.chat_log:
+            self.flush_log(force=True)
+            self.chat_log.close()
+        if self.control: self.control.close()
         pygame.quit()
         sys.exit()
 
 
+class BatchRunner:
+    # 无界面批处理：逐条读取 JSONL 里的问题/图片，用有上限的线程池并发请求，
+    # 结果按输入顺序追加写入输出文件；输出里已有回复的 id 会被跳过，中断后重跑即可续上
+    def __init__(self, config, workers=4, retries=2, backoff=2.0):
+        self.config = config
+        self.workers = max(1, workers)
+        self.retries = retries
+        self.backoff = backoff
+        # 每个后端的连接池至少要容得下全部并发
+        self.api = BackendPool.from_config({**config, "pool_size": max(config.get("pool_size", 2), self.workers)})
+        self.image_pipeline = ImagePipeline.from_config(config)
+        self.context_builder = ContextBuilder.from_config(config)
+
+    @staticmethod
+    def read_records(path):
+        # 每行一条：id (或 request_id)、prompt (或 title/body) 和可选的 image 路径
+        base = os.path.dirname(os.path.abspath(path))
+        with open(path, "r", encoding="utf-8") as f:
+            for n, line in enumerate(f, 1):
+                if not line.strip(): continue
+                rec = json.loads(line)
+                prompt = rec.get("prompt") or "\n\n".join(filter(None, (rec.get("title"), rec.get("body"))))
+                image = rec.get("image")
+                if image: image = os.path.join(base, image)
+                yield {"id": rec.get("id", rec.get("request_id", n)), "prompt": prompt, "image": image}
+
+    @staticmethod
+    def completed_ids(path):
+        done = set()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue  # 中断时写了一半的行
+                    if "reply" in rec: done.add(rec["id"])
+        except FileNotFoundError:
+            pass
+        return done
+
+    def run_one(self, rec):
+        started = time.perf_counter()
+        out = {"id": rec["id"]}
+        for attempt in range(self.retries + 1):
+            try:
+                image = self.image_pipeline.process(rec["image"], preview=False) if rec["image"] else None
+                msgs = build_messages(self.config, self.context_builder, rec["prompt"], image)
+                with self.api.post({"model": self.config.get("model"), "messages": msgs}) as res:
+                    js = json.loads(res.read().decode())
+                out.update(reply=js['choices'][0]['message']['content'], backend=res.backend.name,
+                           model=res.backend.model)
+                out.pop("error", None)
+                break
+            except Exception as e:
+                out["error"] = str(e)
+                if attempt < self.retries: time.sleep(self.backoff * 2 ** attempt)
+        out["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        return out
+
+    def run(self, input_path, output_path):
+        from concurrent.futures import ThreadPoolExecutor
+        done = self.completed_ids(output_path)
+        ok = failed = skipped = 0
+        # 最多同时挂着 workers*2 个任务；总是等最早提交的那个，输出自然保持输入顺序
+        with ThreadPoolExecutor(self.workers) as pool, open(output_path, "a", encoding="utf-8") as out:
+            pending = deque()
+
+            def flush_one():
+                nonlocal ok, failed
+                rec = pending.popleft().result()
+                out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                out.flush()
+                if "error" in rec:
+                    failed += 1
+                    print(f"[{rec['id']}] 失败: {rec['error']}", file=sys.stderr)
+                else:
+                    ok += 1
+
+            for rec in self.read_records(input_path):
+                if rec["id"] in done:
+                    skipped += 1
+                    continue
+                pending.append(pool.submit(self.run_one, rec))
+                if len(pending) >= self.workers * 2: flush_one()
+            while pending:
+                flush_one()
+        self.api.close()
+        print(f"完成 {ok} 条，失败 {failed} 条，跳过已完成 {skipped} 条", file=sys.stderr)
+        return failed
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="桌面宠物；加 --batch 时不开窗口，批量处理 JSONL 里的问题")
+    parser.add_argument("--batch", metavar="INPUT", help="输入 JSONL，每行含 id、prompt 和可选的 image 路径")
+    parser.add_argument("--output", help="结果 JSONL (默认为 <输入文件名>.out.jsonl)")
+    parser.add_argument("--workers", type=int, default=4, help="并发请求数")
+    parser.add_argument("--retries", type=int, default=2, help="每条记录失败后的重试次数")
+    args = parser.parse_args()
+    if not args.batch:
+        DesktopPetWidget().run()
+        return
+    output = args.output or os.path.splitext(args.batch)[0] + ".out.jsonl"
+    runner = BatchRunner(read_config(), workers=args.workers, retries=args.retries)
+    sys.exit(1 if runner.run(args.batch, output) else 0)
+
+
 if __name__ == "__main__":
-    DesktopPetWidget().run()
\ No newline at end of file
+    main()
\ No newline at end of file